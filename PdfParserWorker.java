@@ -0,0 +1,152 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.PrintStream;
+import java.util.ArrayList;
+import java.util.List;
+
+import org.codehaus.jackson.JsonNode;
+import org.codehaus.jackson.map.ObjectMapper;
+import org.codehaus.jackson.node.ArrayNode;
+import org.codehaus.jackson.node.ObjectNode;
+
+/*
+ * Long-lived front end for pdfparser.jar.
+ *
+ * The app runs the compiled PdfParserWorker.class next to this file with the
+ * jar on the classpath (java -cp pdfparser.jar:. PdfParserWorker), after a
+ * change rebuild it for the jar's Java version with
+ *
+ *   javac -source 1.7 -target 1.7 -cp pdfparser.jar PdfParserWorker.java
+ *
+ * Talk to it over stdin/stdout with frames made of a 4 byte big-endian
+ * length followed by that many bytes of UTF-8 JSON.
+ *
+ *   request:  {"args": ["get_fields", "/path/to/file.pdf"]}
+ *   response: {"out": "...", "err": "...", "nanos": 1234}
+ *
+ *   request:  {"batch": [["set_fields", ...], ["concat_files", ...]]}
+ *   response: {"results": [{"out": "...", "err": "..."}, ...]}
+ *
+ * "out" and "err" carry whatever PdfParser.main printed, decoded as
+ * ISO-8859-1 so the client gets back the exact bytes the one-shot CLI would
+ * have written, "nanos" the time PdfParser.main took.  A {"ready": true}
+ * frame is sent once at startup.
+ *
+ * With "--batch manifest.json" it runs the {"commands": [...]} of the
+ * manifest in one JVM instead, prints the batch response and exits.
+ */
+public class PdfParserWorker {
+
+    private static final ObjectMapper MAPPER = new ObjectMapper();
+
+    public static void main(String[] argv) throws Exception {
+        if (argv.length == 2 && "--batch".equals(argv[0])) {
+            runManifest(argv[1]);
+            return;
+        }
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        DataOutputStream out = new DataOutputStream(
+            new BufferedOutputStream(new FileOutputStream(FileDescriptor.out)));
+        PrintStream stderr = System.err;
+        // keep stray prints from the parser away from the framed channel
+        System.setOut(stderr);
+
+        ObjectNode ready = MAPPER.createObjectNode();
+        ready.put("ready", true);
+        writeFrame(out, ready);
+
+        while (true) {
+            JsonNode request;
+            try {
+                request = readFrame(in);
+            } catch (EOFException e) {
+                break;
+            }
+            writeFrame(out, handle(request, stderr));
+        }
+    }
+
+    private static void runManifest(String path) throws Exception {
+        PrintStream stdout = System.out;
+        PrintStream stderr = System.err;
+        JsonNode manifest = MAPPER.readTree(
+            MAPPER.getJsonFactory().createJsonParser(new File(path)));
+        ObjectNode response = runBatch(manifest.get("commands"), stderr);
+        System.setOut(stdout);
+        stdout.print(MAPPER.writeValueAsString(response));
+        stdout.flush();
+    }
+
+    private static ObjectNode handle(JsonNode request, PrintStream stderr) {
+        if (request.has("batch")) {
+            return runBatch(request.get("batch"), stderr);
+        }
+        return run(request.get("args"), stderr);
+    }
+
+    private static ObjectNode runBatch(JsonNode commands, PrintStream stderr) {
+        ObjectNode response = MAPPER.createObjectNode();
+        ArrayNode results = response.putArray("results");
+        for (JsonNode command : commands) {
+            results.add(run(command, stderr));
+        }
+        return response;
+    }
+
+    private static ObjectNode run(JsonNode command, PrintStream stderr) {
+        List<String> args = new ArrayList<String>();
+        for (JsonNode arg : command) {
+            args.add(arg.getTextValue());
+        }
+        ByteArrayOutputStream outBuf = new ByteArrayOutputStream();
+        ByteArrayOutputStream errBuf = new ByteArrayOutputStream();
+        PrintStream capturedOut = new PrintStream(outBuf, true);
+        PrintStream capturedErr = new PrintStream(errBuf, true);
+        System.setOut(capturedOut);
+        System.setErr(capturedErr);
+        long nanos;
+        long start = System.nanoTime();
+        try {
+            PdfParser.main((String[]) args.toArray(new String[args.size()]));
+        } catch (Throwable e) {
+            e.printStackTrace(capturedErr);
+        } finally {
+            nanos = System.nanoTime() - start;
+            capturedOut.flush();
+            capturedErr.flush();
+            System.setOut(stderr);
+            System.setErr(stderr);
+        }
+        ObjectNode response = MAPPER.createObjectNode();
+        response.put("nanos", nanos);
+        try {
+            response.put("out", outBuf.toString("ISO-8859-1"));
+            response.put("err", errBuf.toString("ISO-8859-1"));
+        } catch (java.io.UnsupportedEncodingException e) {
+            response.put("err", e.toString());
+        }
+        return response;
+    }
+
+    private static JsonNode readFrame(DataInputStream in) throws Exception {
+        int length = in.readInt();
+        byte[] payload = new byte[length];
+        in.readFully(payload);
+        String text = new String(payload, "UTF-8");
+        return MAPPER.readTree(MAPPER.getJsonFactory().createJsonParser(text));
+    }
+
+    private static void writeFrame(DataOutputStream out, JsonNode node) throws Exception {
+        byte[] payload = MAPPER.writeValueAsString(node).getBytes("UTF-8");
+        out.writeInt(payload.length);
+        out.write(payload);
+        out.flush();
+    }
+}
@@ -1,13 +1,164 @@
-from flask import Flask, jsonify, render_template, Response
+from flask import Flask, Blueprint, jsonify, render_template, Response, url_for, Request
 from flask import request
 from flask import abort
 from flask import send_file
-import pathlib
 import os
 import subprocess
 import json
-from PyPDF2 import PdfFileMerger
+import struct
+import threading
+import queue
+import atexit
+import hashlib
+import time
+import uuid
+import io
+import math
+import tempfile
+import multiprocessing
+import concurrent.futures
+import shutil
+import sqlite3
+import collections
+import shlex
+import logging
+import random
+import contextlib
+import csv
+import datetime
+from PyPDF2 import PdfFileMerger, PdfFileReader, PdfFileWriter
+from PyPDF2.generic import NameObject, BooleanObject, createStringObject, \
+    ArrayObject, DictionaryObject, IndirectObject, NumberObject, FloatObject, \
+    DecodedStreamObject, StreamObject
+from PyPDF2.pdf import PageObject
 from flask import send_from_directory, send_file
+try:
+    # only needed to import .xlsx rosters
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('flaskapp')
+
+
+def log_sampled(level):
+    """True when a message at `level` should be logged. Debug dumps of
+    payloads and field data are only kept for LOG_SAMPLE_RATE of the calls,
+    so check this before building them.
+    """
+    if not logger.isEnabledFor(level):
+        return False
+    return random.random() < float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+
+
+class Metrics:
+    """Counters and histograms served at /metrics in the Prometheus text
+    format. Everything is per process.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.BUCKETS), 0, 0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    @contextlib.contextmanager
+    def span(self, stage, **labels):
+        """Time the body into flaskapp_stage_seconds{stage=...}"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            labels['stage'] = stage
+            self.observe('flaskapp_stage_seconds', time.perf_counter() - start, labels)
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in labels) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2]))
+                                for k, v in self._histograms.items())
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                text = self._help.get(name, (kind, name))[1]
+                lines.append('# HELP {} {}'.format(name, text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, self._format_labels(labels), value))
+        for (name, labels), (buckets, count, total) in histograms:
+            header(name, 'histogram')
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                lines.append('{}_bucket{} {}'.format(
+                    name, self._format_labels(labels + (('le', bound),)), bucket))
+            lines.append('{}_bucket{} {}'.format(
+                name, self._format_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('{}_count{} {}'.format(name, self._format_labels(labels), count))
+            lines.append('{}_sum{} {}'.format(name, self._format_labels(labels), total))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('flaskapp_stage_seconds', 'histogram',
+                 'Time spent in each stage of the render pipeline')
+metrics.describe('flaskapp_pdfparser_jvm_seconds', 'histogram',
+                 'Time pdfparser commands spent inside the JVM')
+metrics.describe('flaskapp_pdfparser_commands_total', 'counter',
+                 'pdfparser commands run, by command and outcome')
+metrics.describe('flaskapp_schema_cache_requests_total', 'counter',
+                 'Field schema lookups, by result')
+metrics.describe('flaskapp_packet_cache_requests_total', 'counter',
+                 'Rendered packet cache lookups, by result')
+metrics.describe('flaskapp_render_jobs_total', 'counter',
+                 'Finished /submit jobs, by status')
+metrics.describe('flaskapp_students_rendered_total', 'counter',
+                 'Students rendered into packets')
+metrics.describe('flaskapp_queue_wait_seconds', 'histogram',
+                 'Time renders waited for a render slot, by kind')
+metrics.describe('flaskapp_render_rejected_total', 'counter',
+                 'Renders refused with 429 because the queue was full')
 
 
 class PDFParserError(Exception):
@@ -18,13 +169,860 @@ class InvalidOptionError(Exception):
     pass
 
 
+class PDFParserWorkerError(PDFParserError):
+    pass
+
+
+class PDFParserWorker:
+    """A long-lived pdfparser process speaking framed JSON.
+
+    Every frame is a 4 byte big-endian length followed by a UTF-8 JSON
+    document, see PdfParserWorker.java for the protocol.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        ready = self._read_frame()
+        if not ready.get('ready'):
+            self.close()
+            raise PDFParserWorkerError(
+                "pdfparser worker did not start: {}".format(ready))
+
+    def _write_frame(self, data):
+        payload = json.dumps(data).encode('utf-8')
+        self.process.stdin.write(struct.pack('>I', len(payload)) + payload)
+        self.process.stdin.flush()
+
+    def _read_exactly(self, size):
+        data = self.process.stdout.read(size)
+        if data is None or len(data) != size:
+            raise PDFParserWorkerError("pdfparser worker exited unexpectedly")
+        return data
+
+    def _read_frame(self):
+        size, = struct.unpack('>I', self._read_exactly(4))
+        return json.loads(self._read_exactly(size).decode('utf-8'))
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def request(self, payload):
+        """Send one request frame and return the response frame"""
+        try:
+            self._write_frame(payload)
+            return self._read_frame()
+        except (OSError, ValueError) as e:
+            raise PDFParserWorkerError(str(e))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class PDFParserWorkerPool:
+    """Keeps up to `size` pdfparser workers running and hands them out one
+    request at a time. Workers that crash are replaced on the next request.
+    """
+
+    def __init__(self, command, size):
+        self.command = command
+        self.size = size
+        self.pid = os.getpid()
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = 0
+
+    def _acquire(self):
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                spawn = self._started < self.size
+                if spawn:
+                    self._started += 1
+            if spawn:
+                break
+            try:
+                # wake up now and then in case a crashed worker freed a slot
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                continue
+        try:
+            return PDFParserWorker(self.command)
+        except Exception:
+            with self._lock:
+                self._started -= 1
+            raise
+
+    def _release(self, worker):
+        if worker.is_alive():
+            self._idle.put(worker)
+        else:
+            self._discard(worker)
+
+    def _discard(self, worker):
+        worker.close()
+        with self._lock:
+            self._started -= 1
+
+    def _call(self, payload):
+        for attempt in range(2):
+            worker = self._acquire()
+            try:
+                response = worker.request(payload)
+            except PDFParserWorkerError:
+                # the worker crashed, replace it and try once more
+                self._discard(worker)
+                if attempt:
+                    raise
+                continue
+            self._release(worker)
+            return response
+
+    def run(self, args):
+        """Run one pdfparser command and return (stdout, stderr) as the
+        bytes the command line tool would have written
+        """
+        return _decode_worker_result(self._call({'args': args}), args)
+
+    def run_batch(self, commands):
+        """Run a list of pdfparser commands in a single request and return
+        a (stdout, stderr) pair for each of them
+        """
+        response = self._call({'batch': commands})
+        return [_decode_worker_result(result, args)
+                for result, args in zip(response['results'], commands)]
+
+    def spawn_all(self):
+        workers = [self._acquire() for _ in range(self.size)]
+        for worker in workers:
+            self._release(worker)
+
+    def close(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(worker)
+
+
+def _decode_worker_result(result, args):
+    command = args[0] if args else ''
+    if 'nanos' in result:
+        metrics.observe('flaskapp_pdfparser_jvm_seconds', result['nanos'] / 1e9,
+                        {'command': command})
+    metrics.inc('flaskapp_pdfparser_commands_total',
+                {'command': command, 'status': 'error' if result.get('err') else 'ok'})
+    return (result.get('out', '').encode('latin-1'),
+            result.get('err', '').encode('latin-1'))
+
+
+def get_worker_command():
+    """Command that starts a pdfparser worker: the precompiled
+    PdfParserWorker.class from the PDFPARSER_WORKER_PATH directory, run by
+    class name so a plain JRE will do. PDFPARSER_WORKER_COMMAND replaces it
+    with anything that speaks the same protocol.
+    """
+    command = os.environ.get('PDFPARSER_WORKER_COMMAND')
+    if command:
+        return shlex.split(command)
+    classpath = os.pathsep.join([os.environ.get('PDFPARSER_PATH', 'pdfparser.jar'),
+                                 os.environ.get('PDFPARSER_WORKER_PATH', '.')])
+    return ['java', '-cp', classpath, 'PdfParserWorker']
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+# set once the worker command failed to start in --batch mode
+_batch_unavailable = False
+
+
+def get_worker_pool():
+    """Return the pdfparser worker pool for this process, or None when the
+    pool is disabled (PDFPARSER_POOL=0) or the workers could not be started.
+    """
+    global _worker_pool
+    if os.environ.get('PDFPARSER_POOL', '1') == '0':
+        return None
+    with _worker_pool_lock:
+        if _worker_pool is False:
+            return None
+        if _worker_pool is None or _worker_pool.pid != os.getpid():
+            # forked children must not share their parent's pipes
+            command = get_worker_command()
+            size = int(os.environ.get('PDFPARSER_POOL_SIZE', 0)) or os.cpu_count() or 1
+            pool = PDFParserWorkerPool(command, size)
+            try:
+                pool.run(['get_fields'])
+            except (OSError, PDFParserWorkerError) as e:
+                logger.warning("pdfparser worker pool disabled: %s", e)
+                _worker_pool = False
+                return None
+            _worker_pool = pool
+        return _worker_pool
+
+
+@atexit.register
+def _close_worker_pool():
+    if _worker_pool and _worker_pool.pid == os.getpid():
+        _worker_pool.close()
+
+
+class CompiledTemplate:
+    """The fields of one template in the shape a fill needs: the set of
+    field names and the options of each choice field as a frozenset.
+    """
+
+    def __init__(self, field_data):
+        self.names = frozenset(item['name'] for item in field_data['fields'])
+        self.options = {
+            item['name']: item['options']
+            for item in field_data['fields'] if item.get('options')
+        }
+        self.domains = {name: frozenset(options) for name, options in self.options.items()}
+
+    def check(self, answers):
+        """Return the answers for fields this template has, raising
+        InvalidOptionError for a value outside a choice field's options
+        """
+        names = self.names
+        domains = self.domains
+        answer_fields = {}
+        for k, v in answers.items():
+            if k not in names:
+                continue
+            domain = domains.get(k)
+            if domain is not None:
+                try:
+                    valid = v in domain
+                except TypeError:
+                    valid = False
+                if not valid:
+                    raise InvalidOptionError(
+                        "''{}' is not a valid option for '{}'. Choices: {}".format(
+                            v, k, self.options[k]
+                            ))
+            answer_fields[k] = v
+        return answer_fields
+
+
+class FieldSchemaCache:
+    """Caches `get_fields` results per template.
+
+    Entries are keyed by template path, mtime and content hash and are kept
+    in memory and, when `cache_dir` is set, as JSON files named after the
+    content hash so they survive restarts.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._schemas = {}
+        self._templates = {}
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def _content_hash(self, path, stat):
+        stamp = (path, stat.st_mtime_ns, stat.st_size)
+        digest = self._digests.get(stamp)
+        if digest is None:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            self._digests[stamp] = digest
+        return digest
+
+    def key(self, pdf_path):
+        path = os.path.abspath(pdf_path)
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, self._content_hash(path, stat))
+
+    def _disk_path(self, namespace, digest):
+        return os.path.join(self.cache_dir, '{}-{}.json'.format(namespace, digest))
+
+    def _load(self, namespace, digest):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(namespace, digest), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, namespace, digest, schema):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        disk_path = self._disk_path(namespace, digest)
+        tmp_path = disk_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(schema, f)
+        os.replace(tmp_path, disk_path)
+
+    def get(self, pdf_path, loader, namespace='jar'):
+        """Return the field data of `pdf_path`, calling `loader(pdf_path)`
+        only when neither the memory nor the disk cache has it.
+        `namespace` keeps the output of different backends apart.
+        """
+        key = (namespace,) + self.key(pdf_path)
+        schema = self._schemas.get(key)
+        if schema is not None:
+            metrics.inc('flaskapp_schema_cache_requests_total', {'result': 'hit'})
+            return schema
+        schema = self._load(namespace, key[3])
+        if schema is None:
+            metrics.inc('flaskapp_schema_cache_requests_total', {'result': 'miss'})
+            with metrics.span('schema_fetch'):
+                schema = loader(pdf_path)
+            self._store(namespace, key[3], schema)
+        else:
+            metrics.inc('flaskapp_schema_cache_requests_total', {'result': 'disk'})
+        with self._lock:
+            self._schemas[key] = schema
+        return schema
+
+    def get_template(self, pdf_path, loader, namespace='jar'):
+        """Return the CompiledTemplate used to prune and validate answers"""
+        key = (namespace,) + self.key(pdf_path)
+        template = self._templates.get(key)
+        if template is None:
+            template = CompiledTemplate(self.get(pdf_path, loader, namespace))
+            with self._lock:
+                self._templates[key] = template
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._schemas.clear()
+            self._templates.clear()
+            self._digests.clear()
+
+
+field_schema_cache = FieldSchemaCache(
+    os.environ.get('PDFPARSER_SCHEMA_CACHE', '.schema_cache'))
+
+
+COURSE_TYPES = ('ACLS', 'BLS', 'PALS')
+
+
+class TemplateCatalog:
+    """Index of the checklist templates shipped in the ACLS/BLS/PALS folders
+    under `root`, keyed by file name without the .pdf extension.
+
+    The course folders are re-scanned when their mtimes change, checked at
+    most once every `poll_interval` seconds.
+    """
+
+    def __init__(self, root, poll_interval=2.0):
+        self.root = root
+        self.poll_interval = poll_interval
+        self._templates = {}
+        self._dir_mtimes = {}
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def _scan(self):
+        templates = {}
+        dir_mtimes = {}
+        for course in COURSE_TYPES:
+            course_dir = os.path.join(self.root, course)
+            if not os.path.isdir(course_dir):
+                continue
+            for dirpath, dirnames, filenames in os.walk(course_dir):
+                dir_mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+                for filename in sorted(filenames):
+                    name, ext = os.path.splitext(filename)
+                    if ext.lower() != '.pdf' or name in templates:
+                        continue
+                    templates[name] = (os.path.join(dirpath, filename), course)
+        return templates, dir_mtimes
+
+    def _changed(self):
+        for dirpath, mtime in self._dir_mtimes.items():
+            try:
+                if os.stat(dirpath).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        for course in COURSE_TYPES:
+            course_dir = os.path.join(self.root, course)
+            if course_dir not in self._dir_mtimes and os.path.isdir(course_dir):
+                return True
+        return False
+
+    def refresh(self):
+        templates, dir_mtimes = self._scan()
+        with self._lock:
+            self._templates = templates
+            self._dir_mtimes = dir_mtimes
+            self._checked_at = time.monotonic()
+
+    def _poll(self):
+        if time.monotonic() - self._checked_at < self.poll_interval:
+            return
+        self._checked_at = time.monotonic()
+        if self._changed():
+            self.refresh()
+
+    def _entry(self, name):
+        self._poll()
+        if name.lower().endswith('.pdf'):
+            name = name[:-4]
+        return self._templates.get(name)
+
+    def get(self, name):
+        """Return the path of template `name` or None"""
+        with metrics.span('catalog_lookup'):
+            entry = self._entry(name)
+        return entry[0] if entry else None
+
+    def course_of(self, name):
+        """Return 'ACLS', 'BLS' or 'PALS' for template `name` or None"""
+        entry = self._entry(name)
+        return entry[1] if entry else None
+
+    def names(self):
+        self._poll()
+        return sorted(self._templates)
+
+    def file_names(self):
+        return [os.path.basename(self._templates[name][0]) for name in self.names()]
+
+
+template_catalog = None
+
+
+def get_template_catalog():
+    global template_catalog
+    if template_catalog is None:
+        template_catalog = TemplateCatalog(
+            parent_directory,
+            float(os.environ.get('TEMPLATE_CATALOG_POLL', 2)))
+    return template_catalog
+
+
+def get_scratch_root():
+    """Where intermediate pdfs go: PDFPARSER_SCRATCH_DIR if set, else
+    /dev/shm so they stay in memory, else the system temp directory
+    """
+    root = os.environ.get('PDFPARSER_SCRATCH_DIR')
+    if root:
+        return root
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class ScratchSpace:
+    """A private directory for the intermediate files of one request, so
+    concurrent submissions never share file names
+    """
+
+    def __init__(self, root=None):
+        self.directory = tempfile.mkdtemp(
+            prefix='flaskapp-', dir=root or get_scratch_root())
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+
+class PDFBackend:
+    """The operations PDFParser needs from a pdf library.
+
+    `get_fields` returns field data in the shape pdfparser.jar prints, i.e.
+    {'fields': [{'name': ..., 'type': ..., 'value': ..., 'options': ...}]}
+
+    Backends with `in_memory` set also accept file objects for every input
+    and output path, so PDFParser can skip temp files altogether.
+    """
+
+    name = None
+    in_memory = False
+
+    def get_fields(self, pdf_path):
+        raise NotImplementedError
+
+    def set_fields(self, pdf_path, output_path, answers):
+        raise NotImplementedError
+
+    def concat_files(self, pdf_paths, output_path):
+        raise NotImplementedError
+
+    def fill_batch(self, items, output_paths, concat_output_path=None):
+        """Fill every (pdf_path, answers) of `items` into the matching entry
+        of `output_paths` and, when `concat_output_path` is given, join all
+        of them into it. Backends override this to do it in one go.
+        """
+        for (pdf_path, answers), output_path in zip(items, output_paths):
+            self.set_fields(pdf_path, output_path, answers)
+        if concat_output_path is not None:
+            for output_path in output_paths:
+                if not isinstance(output_path, str):
+                    output_path.seek(0)
+            self.concat_files(output_paths, concat_output_path)
+
+
+class JarBackend(PDFBackend):
+    """Runs pdfparser.jar, through the worker pool when it is available"""
+
+    name = 'jar'
+
+    def __init__(self, pdfparser_path=None):
+        self.PDFPARSER_PATH = pdfparser_path or os.environ.get(
+            'PDFPARSER_PATH', 'pdfparser.jar')
+
+    def run_command(self, args):
+        """Run a command to pdftk on the command line.
+            `args` is a list of command line arguments.
+        This method is reponsible for handling errors that arise from
+        pdftk's CLI
+        """
+        command = args[0] if args else ''
+        with metrics.span('run_command', command=command):
+            pool = get_worker_pool()
+            if pool is not None:
+                out, err = pool.run(args)
+            else:
+                args = ['java', '-jar', self.PDFPARSER_PATH] + args
+                process = subprocess.Popen(
+                    args,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+                out, err = process.communicate()
+                metrics.inc('flaskapp_pdfparser_commands_total',
+                            {'command': command, 'status': 'error' if err else 'ok'})
+        if err:
+            raise PDFParserError(err.decode('utf-8'))
+        return out.decode('unicode_escape')
+
+    def run_batch(self, commands):
+        """Run several pdfparser commands in one JVM and return the output
+        of each. Arguments travel in a manifest, never on the command line.
+        """
+        with metrics.span('run_batch'):
+            pool = get_worker_pool()
+            if pool is not None:
+                results = pool.run_batch(commands)
+            else:
+                results = self._run_manifest(commands)
+            if results is None:
+                # the worker cannot start here (e.g. java 8 has no source
+                # launcher), run the commands one by one with java -jar
+                return [self.run_command(args) for args in commands]
+        outputs = []
+        for out, err in results:
+            if err:
+                raise PDFParserError(err.decode('utf-8'))
+            outputs.append(out.decode('unicode_escape'))
+        return outputs
+
+    def _run_manifest(self, commands):
+        """Run `commands` with one `--batch` worker process, None when the
+        worker command does not start
+        """
+        global _batch_unavailable
+        if _batch_unavailable or _worker_pool is False:
+            return None
+        os_int, manifest_path = tempfile.mkstemp(
+            suffix='.json', dir=get_scratch_root())
+        with os.fdopen(os_int, 'w') as manifest:
+            json.dump({'commands': commands}, manifest)
+        try:
+            process = subprocess.Popen(
+                get_worker_command() + ['--batch', manifest_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            out, err = process.communicate()
+        except OSError as e:
+            err, process = str(e).encode('utf-8'), None
+        finally:
+            os.remove(manifest_path)
+        # failing commands are reported in the results, an exit status
+        # means the worker itself did not run
+        if process is None or process.returncode:
+            logger.warning("pdfparser --batch disabled: %s", err.decode('utf-8', 'replace'))
+            _batch_unavailable = True
+            return None
+        return [_decode_worker_result(result, args) for result, args in
+                zip(json.loads(out.decode('utf-8'))['results'], commands)]
+
+    def get_fields(self, pdf_path):
+        return json.loads(self.run_command(['get_fields', pdf_path]))
+
+    def set_fields(self, pdf_path, output_path, answers):
+        answer_fields = {'fields': [{k: v} for k, v in answers.items()]}
+        self.run_command([
+            'set_fields',
+            pdf_path,
+            output_path,
+            json.dumps(answer_fields)
+        ])
+
+    def concat_files(self, pdf_paths, output_path):
+        self.run_command(['concat_files'] + list(pdf_paths) + [output_path])
+
+    def fill_batch(self, items, output_paths, concat_output_path=None):
+        commands = [
+            ['set_fields', pdf_path, output_path,
+             json.dumps({'fields': [{k: v} for k, v in answers.items()]})]
+            for (pdf_path, answers), output_path in zip(items, output_paths)
+        ]
+        if concat_output_path is not None:
+            commands.append(['concat_files'] + list(output_paths) + [concat_output_path])
+        self.run_batch(commands)
+
+
+class PyPDF2Backend(PDFBackend):
+    """Fills and merges AcroForms in process with PyPDF2.
+
+    Values are written to the fields, text and choice widgets get a plain
+    Helvetica appearance stream with the value and checkboxes their /AS
+    state. /NeedAppearances is set as well for viewers that rebuild them,
+    merged packets lose it along with the /AcroForm.
+    """
+
+    name = 'pypdf2'
+    in_memory = True
+
+    FF_RADIO = 1 << 15
+    FF_PUSHBUTTON = 1 << 16
+    FF_COMBO = 1 << 17
+
+    def _reader(self, pdf_path):
+        return PdfFileReader(pdf_path, strict=False)
+
+    def _parent(self, field):
+        parent = field.get('/Parent')
+        return parent.getObject() if parent is not None else None
+
+    def _full_name(self, field):
+        parts = []
+        while field is not None:
+            if '/T' in field:
+                parts.append(field['/T'])
+            field = self._parent(field)
+        return '.'.join(reversed(parts))
+
+    def _inherited(self, field, key):
+        while field is not None:
+            if key in field:
+                return field[key]
+            field = self._parent(field)
+        return None
+
+    def _field_type(self, field):
+        ft = self._inherited(field, '/FT')
+        flags = int(self._inherited(field, '/Ff') or 0)
+        if ft == '/Btn':
+            if flags & self.FF_PUSHBUTTON:
+                return 'button'
+            if flags & self.FF_RADIO:
+                return 'radio button'
+            return 'checkbox'
+        if ft == '/Tx':
+            return 'text'
+        if ft == '/Ch':
+            return 'combo box' if flags & self.FF_COMBO else 'listbox'
+        if ft == '/Sig':
+            return 'signature'
+        return 'unknown'
+
+    def _widgets(self, reader):
+        """Yield (field dict, widget annotation) for every widget in the
+        document, the field dict being the one carrying the /T name
+        """
+        for page in reader.pages:
+            for annot in page.get('/Annots') or []:
+                annot = annot.getObject()
+                if annot.get('/Subtype') != '/Widget':
+                    continue
+                field = annot if '/T' in annot else self._parent(annot)
+                if field is None:
+                    continue
+                yield field, annot
+
+    def _appearance_states(self, annot):
+        states = []
+        ap = annot.get('/AP')
+        if ap is None:
+            return states
+        for key in ('/N', '/D'):
+            appearances = ap.getObject().get(key)
+            if appearances is None:
+                continue
+            appearances = appearances.getObject()
+            if hasattr(appearances, 'keys') and '/Length' not in appearances:
+                for state in appearances.keys():
+                    if state[1:] not in states:
+                        states.append(state[1:])
+        return states
+
+    def _export_values(self, field):
+        """The /Opt of a checkbox or radio group, whose appearance states
+        are then the indexes into it
+        """
+        return [str(option.getObject()) for option in self._inherited(field, '/Opt') or []]
+
+    def get_fields(self, pdf_path):
+        reader = self._reader(pdf_path)
+        fields = {}
+        for field, annot in self._widgets(reader):
+            name = self._full_name(field)
+            item = fields.get(name)
+            if item is None:
+                value = self._inherited(field, '/V')
+                if isinstance(value, NameObject):
+                    value = value[1:]
+                item = fields[name] = {
+                    'name': name,
+                    'type': self._field_type(field),
+                    'value': value,
+                    'options': None,
+                }
+                if item['type'] in ('checkbox', 'radio button'):
+                    # like pdfparser.jar, report an index state by its
+                    # export value and accept both
+                    item['options'] = self._export_values(field)
+                    if isinstance(value, str) and value.isdigit() \
+                            and int(value) < len(item['options']):
+                        item['value'] = item['options'][int(value)]
+            if item['type'] in ('checkbox', 'radio button'):
+                options = item['options']
+                options.extend(o for o in self._appearance_states(annot) if o not in options)
+                item['options'] = options
+            elif item['type'] in ('combo box', 'listbox') and item['options'] is None:
+                options = []
+                for option in self._inherited(field, '/Opt') or []:
+                    option = option.getObject()
+                    # options are either strings or [export value, label] pairs
+                    options.append(option[0] if isinstance(option, list) else option)
+                item['options'] = options
+        return {'fields': list(fields.values())}
+
+    def _appearance(self, writer, field, annot, value):
+        """Return a normal appearance stream showing `value` in `annot`"""
+        rect = [float(v) for v in annot['/Rect']]
+        width, height = abs(rect[2] - rect[0]), abs(rect[3] - rect[1])
+        painter = FieldPainter()
+        text = painter._draw_text(
+            [0, 0, width, height], painter._font_size(self._inherited(field, '/DA')), value)
+        stream = DecodedStreamObject()
+        stream.setData(b'/Tx BMC q ' + text + b'Q EMC\n')
+        stream.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/BBox'): ArrayObject([NumberObject(0), NumberObject(0),
+                                              FloatObject(width), FloatObject(height)]),
+            NameObject('/Resources'): DictionaryObject({NameObject('/Font'): DictionaryObject(
+                {painter.FONT_NAME: painter.font})}),
+        })
+        return writer._addObject(stream)
+
+    def _fill_reader(self, reader, answers, writer):
+        # names of the button fields one of whose widgets took the value
+        chosen = set()
+        for field, annot in self._widgets(reader):
+            name = self._full_name(field)
+            if name not in answers:
+                continue
+            value = answers[name]
+            if self._field_type(field) in ('checkbox', 'radio button'):
+                export_values = self._export_values(field)
+                if value in export_values:
+                    value = str(export_values.index(value))
+                if value in self._appearance_states(annot):
+                    state = NameObject('/' + value)
+                    chosen.add(name)
+                else:
+                    state = NameObject('/Off')
+                # the other widgets of a radio group must not reset its value
+                if name in chosen:
+                    field[NameObject('/V')] = NameObject('/' + value)
+                else:
+                    field[NameObject('/V')] = state
+                annot[NameObject('/AS')] = state
+            else:
+                field[NameObject('/V')] = createStringObject(str(value))
+                if self._field_type(field) in ('text', 'combo box', 'listbox'):
+                    annot[NameObject('/AP')] = DictionaryObject(
+                        {NameObject('/N'): self._appearance(writer, field, annot, value)})
+
+    def set_fields(self, pdf_path, output_path, answers):
+        reader = self._reader(pdf_path)
+        writer = PdfFileWriter()
+        self._fill_reader(reader, answers, writer)
+        for page in reader.pages:
+            writer.addPage(page)
+        acro_form = reader.trailer['/Root'].get('/AcroForm')
+        if acro_form is not None:
+            acro_form.getObject()[NameObject('/NeedAppearances')] = BooleanObject(True)
+            writer._root_object[NameObject('/AcroForm')] = acro_form
+        self._write(writer, output_path)
+
+    def concat_files(self, pdf_paths, output_path):
+        merger = PdfFileMerger(strict=False)
+        for path in pdf_paths:
+            merger.append(path)
+        self._write(merger, output_path)
+        merger.close()
+
+    def _write(self, writer, output_path):
+        if not isinstance(output_path, str):
+            writer.write(output_path)
+            return
+        with open(output_path, 'wb') as output:
+            writer.write(output)
+
+
+BACKENDS = {
+    JarBackend.name: JarBackend,
+    PyPDF2Backend.name: PyPDF2Backend,
+}
+
+
+def get_backend(name=None):
+    """Create the fill backend named `name`, by default the one set in the
+    PDFPARSER_BACKEND environment variable ('jar' or 'pypdf2')
+    """
+    name = name or os.environ.get('PDFPARSER_BACKEND', 'jar')
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise PDFParserError("unknown pdf backend '{}'".format(name))
+
+
 class PDFParser:
 
-    def __init__(self, tmp_path=None, clean_up=True):
+    def __init__(self, tmp_path=None, clean_up=True, backend=None):
         self.TEMP_FOLDER_PATH = tmp_path
         self._tmp_files = []
         self.clean_up = clean_up
         self.PDFPARSER_PATH = os.environ.get('PDFPARSER_PATH', 'pdfparser.jar')
+        if backend is None or isinstance(backend, str):
+            backend = get_backend(backend)
+        self.backend = backend
 
     def _coerce_to_file_path(self, path_or_file_or_bytes):
         """This converts file-like objects and `bytes` into
@@ -41,15 +1039,26 @@ class PDFParser:
                     file_obj=path_or_file_or_bytes)
         return path_or_file_or_bytes
 
+    def _coerce_to_input(self, path_or_file_or_bytes):
+        """Like _coerce_to_file_path, but hands bytes to in memory backends
+        as a file object instead of writing them out
+        """
+        if self.backend.in_memory and not isinstance(path_or_file_or_bytes, str):
+            if isinstance(path_or_file_or_bytes, bytes):
+                return io.BytesIO(path_or_file_or_bytes)
+            return path_or_file_or_bytes
+        return self._coerce_to_file_path(path_or_file_or_bytes)
+
     def _write_tmp_file(self, file_obj=None, bytestring=None):
         """Take a file-like object or a bytestring,
         create a temporary file and return a file path.
         file-like objects will be read and written to the tempfile
         bytes objects will be written directly to the tempfile
+        temp files are created in `tmp_path`, a directory
         """
-        tmp_path = self.TEMP_FOLDER_PATH
-        # os_int, tmp_fp = mkstemp(dir=tmp_path)
-        with open(tmp_path, 'wb') as tmp_file:
+        os_int, tmp_path = tempfile.mkstemp(
+            suffix='.pdf', dir=self.TEMP_FOLDER_PATH or get_scratch_root())
+        with os.fdopen(os_int, 'wb') as tmp_file:
             if file_obj:
                 tmp_file.write(file_obj.read())
             elif bytestring:
@@ -70,304 +1079,2723 @@ class PDFParser:
             path = self._tmp_files.pop()
             os.remove(path)
 
-    def _get_name_option_lookup(self, field_data):
-        return {
-            item['name']: item.get('options', None)
-            for item in field_data['fields']
-        }
-
     def _get_file_contents(self, path):
         """given a file path, return the contents of the file
         if decode is True, the contents will be decoded using the default
         encoding
         """
-        return open(path, 'rb').read()
+        if not isinstance(path, str):
+            return path.getvalue()
+        with open(path, 'rb') as f:
+            return f.read()
 
-    def run_command(self, args):
-        """Run a command to pdftk on the command line.
-            `args` is a list of command line arguments.
-        This method is reponsible for handling errors that arise from
-        pdftk's CLI
-        """
-        args = ['java', '-jar', self.PDFPARSER_PATH] + args
-        process = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        out, err = process.communicate()
-        if err:
-            raise PDFParserError(err.decode('utf-8'))
-        return out.decode('unicode_escape')
+    def _new_output(self):
+        if self.backend.in_memory:
+            return io.BytesIO()
+        return self._write_tmp_file()
 
-    def _fill(self, pdf_path, output_path, option_check, answers):
-        answer_fields = {'fields': []}
-        for k, v in answers.items():
-            if k in option_check:
-                if option_check[k]:
-                    if v not in option_check[k]:
-                        raise InvalidOptionError(
-                            "''{}' is not a valid option for '{}'. Choices: {}".format(
-                                v, k, option_check[k]
-                                ))
-            answer_fields['fields'].append({k: v})
-        self.run_command([
-            'set_fields',
-            pdf_path,
-            output_path,
-            self._dump_json(answer_fields)
-        ])
+    def _fill(self, pdf_path, output_path, template, answers):
+        self.backend.set_fields(pdf_path, output_path, template.check(answers))
 
     def join_pdfs(self, list_of_pdf_paths):
-        paths = [self._coerce_to_file_path(p) for p in list_of_pdf_paths]
-        output_path = self._write_tmp_file()
-        args = ['concat_files'] + paths + [output_path]
-        self.run_command(args)
+        paths = [self._coerce_to_input(p) for p in list_of_pdf_paths]
+        output_path = self._new_output()
+        self.backend.concat_files(paths, output_path)
         result = self._get_file_contents(output_path)
         if self.clean_up:
             self.clean_up_tmp_files()
         return result
 
     def get_field_data(self, pdf_file_path):
-        pdf_file_path = self._coerce_to_file_path(pdf_file_path)
-        string = self.run_command(['get_fields', pdf_file_path])
-        return self._load_json(string)
-
-    def fill_pdf(self, pdf_path, answers):
-        pdf_path = self._coerce_to_file_path(pdf_path)
-        field_data = self.get_field_data(pdf_path)
-        option_check = self._get_name_option_lookup(field_data)
-        output_path = self._write_tmp_file()
-        self._fill(pdf_path, output_path, option_check, answers)
+        if not isinstance(pdf_file_path, str):
+            return self.backend.get_fields(
+                self._coerce_to_input(pdf_file_path))
+        return field_schema_cache.get(
+            pdf_file_path, self.backend.get_fields, self.backend.name)
+
+    def get_template(self, pdf_path):
+        """Return the CompiledTemplate of `pdf_path`, cached for paths"""
+        if not isinstance(pdf_path, str):
+            return CompiledTemplate(self.backend.get_fields(pdf_path))
+        return field_schema_cache.get_template(
+            pdf_path, self.backend.get_fields, self.backend.name)
+
+    def fill_pdf(self, pdf_path, answers, flatten=False):
+        """Fill `pdf_path` with `answers` and return the pdf bytes, with
+        the fields baked into the pages when `flatten` is set
+        """
+        pdf_path = self._coerce_to_input(pdf_path)
+        template = self.get_template(pdf_path)
+        output_path = self._new_output()
+        self._fill(pdf_path, output_path, template, answers)
         result = self._get_file_contents(output_path)
         if self.clean_up:
             self.clean_up_tmp_files()
-        return result
+        return flatten_pdf(result) if flatten else result
 
     def fill_many_pdfs(self, pdf_path, answers_list):
+        return self.fill_batch(
+            [(pdf_path, answers) for answers in answers_list], concatenate=True)
 
-        # don't clean up while filling multiple pdfs
-        _clean_up_setting = self.clean_up
-        self.clean_up = False
+    def fill_batch(self, manifest, concatenate=False, flatten=False):
+        """Fill every (pdf_path, answers) pair of `manifest` with a single
+        backend invocation. Returns the filled pdfs as a list of bytes, or
+        all of them joined into one pdf when `concatenate` is set. With
+        `flatten` every pdf is flattened before it is joined.
+        """
+        if flatten:
+            documents = [flatten_pdf(document) for document in self.fill_batch(manifest)]
+            return concat_pdfs(documents) if concatenate else documents
 
-        pdf_path = self._coerce_to_file_path(pdf_path)
-        field_data = self.get_field_data(pdf_path)
-        option_check = self._get_name_option_lookup(field_data)
-        tmp_filled_pdf_paths = []
-        for answers in answers_list:
-            output_path = self._write_tmp_file()
-            self._fill(pdf_path, output_path, option_check, answers)
-            tmp_filled_pdf_paths.append(output_path)
-        self.clean_up = _clean_up_setting
-        return self.join_pdfs(tmp_filled_pdf_paths)
+        items = []
+        inputs = {}
+        for pdf_path, answers in manifest:
+            if isinstance(pdf_path, str):
+                pdf_input, template = pdf_path, self.get_template(pdf_path)
+            else:
+                # the same bytes or file object is only written out once
+                entry = inputs.get(id(pdf_path))
+                if entry is None:
+                    pdf_input = self._coerce_to_input(pdf_path)
+                    entry = inputs[id(pdf_path)] = (pdf_input, self.get_template(pdf_input))
+                pdf_input, template = entry
+            items.append((pdf_input, template.check(answers)))
+        output_paths = [self._new_output() for _ in items]
+        concat_output_path = self._new_output() if concatenate else None
+        self.backend.fill_batch(items, output_paths, concat_output_path)
+        if concatenate:
+            result = self._get_file_contents(concat_output_path)
+        else:
+            result = [self._get_file_contents(p) for p in output_paths]
+        if self.clean_up:
+            self.clean_up_tmp_files()
+        return result
 
 
-app = Flask(__name__)
+class StreamingPdfWriter:
+    """Concatenates pdf documents front to back so the output can be sent
+    while later documents are still being rendered.
 
+    Each document's pages and the objects they use are written out as soon
+    as it is added; the page tree, catalog and xref table follow in
+    `finish()`.
 
-@app.route('/', methods=['GET'])
-def show_html():
-    rootdir = pathlib.Path(parent_directory)
-    file_list = [f.name for f in rootdir.glob('**/*') if f.is_file() and f.name.endswith(".pdf")]
-    print(file_list)
-    return render_template('index_newmilestone4.html', data=file_list)
+    With `dedupe` an object that is identical, down to everything it refers
+    to, to one written for an earlier document is not written again but
+    shared, so the fonts, images and page content of a template every
+    student's copy carries end up in the output once.
+    """
 
+    # dictionaries with any of these keys belong to a single page (pages,
+    # annotations, form fields) and are never shared
+    UNSHARED_KEYS = ('/Parent', '/Kids', '/Rect', '/FT', '/T', '/P')
 
-@app.route('/download', methods=['POST'])
-def download():
-    json_obj = request.get_json()
-    print("Hi")
-    # return jsonify({"status": "success", "filepath": ""})
-    # return send_from_directory(directory=parent_directory, filename=json_obj['filename']+".pdf")
-    return send_file(os.path.join(parent_directory, json_obj['filename']+".pdf"), as_attachment=True)
-    # with open(os.path.join(parent_directory, json_obj['filename']+".pdf")) as f:
-    #     data = f.read()
-    # resp = Response(data, mimetype="application/octet-stream")
-    # resp.headers["Content-Length"] = os.path.getsize(os.path.join(parent_directory, json_obj['filename']+".pdf"))
-    # resp.headers["Content-Disposition"] = "attachment; filename=%s" % os.path.basename(os.path.join(parent_directory, json_obj['filename']+".pdf"))
-    # return resp
+    def __init__(self, dedupe=False):
+        self._offsets = [None]
+        self._position = 0
+        self._kids = ArrayObject()
+        self._pages_num = self._reserve()
+        # content digest -> object number of everything written so far
+        self._shared = {} if dedupe else None
 
+    def _reserve(self):
+        self._offsets.append(None)
+        return len(self._offsets) - 1
 
-@app.route('/submit', methods=['POST'])
-def submit_form():
-    if not request.json or len(request.json) < 0:
-        abort(400)
-    json_obj = request.get_json()
-    print(json_obj)
-    data_to_replace_in_pdf = json_obj['courseInfo']
-    assisting_instructors = json_obj['assistingInstructors']
-    for key, value in assisting_instructors.items():
-        if "assis-name" in key:
-            key = key.split('-')[-1]
-            if key == "0":
-                key = "Name-Instructor ID"
-            else:
-                key = "Name-Instructor ID " + str(int(key)+1)
-        else:
-            key = key.split('-')[-1]
-            if key == "0":
-                key = "Card Exp Date"
-            else:
-                key = "Card Exp Date " + str(int(key) + 1)
-        data_to_replace_in_pdf[key] = value
-
-    course_participants = json_obj['courseParticipants']
-    data_to_replace_in_pdf.update(course_participants)
-    # this is mainly for BLS
-    data_to_replace_in_pdf['Signature'] = data_to_replace_in_pdf['Lead Instructor Signature']
-    data_to_replace_in_pdf['Date 2'] = data_to_replace_in_pdf['Date']
-    data_to_replace_in_pdf['Lead Instructor 2'] = data_to_replace_in_pdf['Lead Instructor']
-    data_to_replace_in_pdf['Lead Instructor ID# 2'] = data_to_replace_in_pdf['Lead Instructor ID#']
-    data_to_replace_in_pdf['Card Expriation Date'] = data_to_replace_in_pdf['Card Expiration Date']
-
-    # for k in range(13):
-    #     data_to_replace_in_pdf['Student Name '+str(k)] = data_to_replace_in_pdf['Student Name']
-    #     data_to_replace_in_pdf['Date of Test '+str(k)] = data_to_replace_in_pdf['Date of Test']
-    #     data_to_replace_in_pdf['Instructor Initials '+str(k)] = data_to_replace_in_pdf['Instructor Initials']
-    #     data_to_replace_in_pdf['Instructor Number '+str(k)] = data_to_replace_in_pdf['Instructor Number']
-    #     data_to_replace_in_pdf['Date '+str(k)] = data_to_replace_in_pdf['Date']
-
-    course_participants1 = json_obj['courseParticipants1']
-    i = 1
-    for key, value in course_participants1.items():
-        if "cp-name" in key:
-            key = key.split('-')[-1]
-            if key == "0":
-                key = "Name"
-            else:
-                key = "Name " + str(int(key)+1)
-        elif "cp-mailing" in key:
-            key = key.split('-')[-1]
-            if key == "0":
-                key = "Mailing Address"
-            else:
-                key = "Mailing Address " + str(int(key)+1)
-        elif "cp-email" in key:
-            key = key.split('-')[-1]
-            if key == "0":
-                key = "Email"
-            else:
-                key = "Email " + str(int(key)+1)
-        elif "cp-phone" in key:
-            key = key.split('-')[-1]
-            if key == "0":
-                key = "Telephone"
-            else:
-                key = "Telephone " + str(int(key)+1)
-        elif "cp-psa" in key:
-            key = key.split('-')[-1]
-            if key == "0":
-                key = "PSA"
-            else:
-                key = "PSA " + str(int(key)+1)
-        elif "cp-comp-imcomp" in key:
-            key = key.split('-')[-1]
-            if key == "0":
-                key = "Complete-Incomplete"
-            else:
-                key = "Complete-Incomplete " + str(int(key)+1)
-        elif "cp-remed" in key:
-            key = key.split('-')[-1]
-            if key == "0":
-                key = "Remediation"
+    def _ref(self, num):
+        return IndirectObject(num, 0, self)
+
+    def _emit(self, data):
+        self._position += len(data)
+        return data
+
+    def _write_object(self, num, obj):
+        buf = io.BytesIO()
+        buf.write(b'%d 0 obj\n' % num)
+        obj.writeToStream(buf, None)
+        buf.write(b'\nendobj\n')
+        self._offsets[num] = self._position
+        return self._emit(buf.getvalue())
+
+    def header(self):
+        return self._emit(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+    def add_document(self, pdf_bytes):
+        """Append every page of `pdf_bytes` and return the bytes to send"""
+        reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+        numbers = {}
+        pending = []
+        digests = {}
+
+        def remap(obj):
+            if isinstance(obj, IndirectObject):
+                key = (obj.idnum, obj.generation)
+                if key not in numbers:
+                    digest = self._digest(obj, digests) if self._shared is not None else None
+                    if digest is not None and digest in self._shared:
+                        numbers[key] = self._shared[digest]
+                    else:
+                        numbers[key] = self._reserve()
+                        pending.append((numbers[key], obj.getObject()))
+                        if digest is not None:
+                            self._shared[digest] = numbers[key]
+                return self._ref(numbers[key])
+            if isinstance(obj, DictionaryObject):
+                for key, value in list(dict.items(obj)):
+                    dict.__setitem__(obj, key, remap(value))
+            elif isinstance(obj, ArrayObject):
+                for index, value in enumerate(obj):
+                    obj[index] = remap(value)
+            return obj
+
+        pages = []
+        for page in reader.pages:
+            ref = page.indirectRef
+            num = numbers[(ref.idnum, ref.generation)] = self._reserve()
+            digests[(ref.idnum, ref.generation)] = None
+            pages.append((num, page))
+
+        chunks = []
+        for num, page in pages:
+            del page['/Parent']
+            remap(page)
+            page[NameObject('/Parent')] = self._ref(self._pages_num)
+            chunks.append(self._write_object(num, page))
+            self._kids.append(self._ref(num))
+        while pending:
+            num, obj = pending.pop()
+            chunks.append(self._write_object(num, remap(obj)))
+        return b''.join(chunks)
+
+    def _digest(self, ref, digests):
+        """Return a digest of the object `ref` points to and everything it
+        refers to, or None when it must not be shared. `digests` memoizes
+        them for one document.
+        """
+        key = (ref.idnum, ref.generation)
+        if key in digests:
+            return digests[key]
+        # anything that loops back here while it is worked out is in a
+        # cycle and not shared
+        digests[key] = None
+        obj = ref.getObject()
+        if isinstance(obj, DictionaryObject) and \
+                any(dict.__contains__(obj, name) for name in self.UNSHARED_KEYS):
+            return None
+        data = self._canonical(obj, digests)
+        if data is not None:
+            digests[key] = hashlib.sha256(data).digest()
+        return digests[key]
+
+    def _canonical(self, obj, digests):
+        if isinstance(obj, IndirectObject):
+            digest = self._digest(obj, digests)
+            return None if digest is None else b'R' + digest
+        if isinstance(obj, (DictionaryObject, ArrayObject)):
+            if isinstance(obj, DictionaryObject):
+                items = sorted(dict.items(obj))
+                chunks, end = [b'<<'], b'>>'
             else:
-                key = "Remediation " + str(int(key)+1)
-        data_to_replace_in_pdf[key] = value
-    selected_options = json_obj['selectedOptions']
-    pdf_path = None
-    merger = PdfFileMerger()
-    rootdir = pathlib.Path(parent_directory)
-    file_list = [f for f in rootdir.glob('**/*') if f.is_file() and f.name.endswith(".pdf")]
-    files_to_delete = []
-    for each_selected in selected_options:
-        if not each_selected == "2020 Guidelines BLS Course Roster_ucm_506772_unlocked (1)":
-            continue
-        pdf_path = each_selected+".pdf"
-        obj = PDFParser(tmp_path=os.path.join(parent_directory, pdf_path), clean_up=True)
-
-        for x in file_list:
-            if x.name == pdf_path:
-                pdf_path = str(x)
-                print(pdf_path)
-
-        data = obj.get_field_data(pdf_path)
-        print(json.dumps(data))
-
-        print(json.dumps(data_to_replace_in_pdf))
-        new_pdf = obj.fill_pdf(pdf_path, data_to_replace_in_pdf)
-        new_pdf = obj._write_tmp_file(bytestring=new_pdf)
-        merger.append(new_pdf)
-
-        files_to_delete.append(new_pdf)
-
-    if "2020 Guidelines BLS Course Roster_ucm_506772_unlocked (1)" in selected_options:
-        selected_options.pop(selected_options.index("2020 Guidelines BLS Course Roster_ucm_506772_unlocked (1)"))
-
-    course_participants1 = json_obj['courseParticipants1']
-    students_info = course_participants1['student-info']
-    student_files = []
-    i = 1
-    for each_obj in students_info:
-        each_student_merger = PdfFileMerger()
-        each_student_info = dict()
-        selected_checkboxes = []
-        selected_checkboxes.extend(selected_options)
-        each_student_info["Student Name"] = each_obj['cp-name']
-        each_student_info["Date of Test"] = each_obj['cp-dot']
-        each_student_info['Instructor Initials'] = data_to_replace_in_pdf['Instructor Initials']
-        each_student_info['Instructor Number'] = data_to_replace_in_pdf['Instructor Number']
-        each_student_info['Date'] = data_to_replace_in_pdf['Date']
-        selected_checkboxes.extend(each_obj['selected-checkboxes'])
-
-        for k in range(13):
-            each_student_info['Student Name '+str(k)] = each_student_info['Student Name']
-            each_student_info['Date of Test '+str(k)] = each_student_info['Date of Test']
-            each_student_info['Instructor Initials '+str(k)] = each_student_info['Instructor Initials']
-            each_student_info['Instructor Number '+str(k)] = each_student_info['Instructor Number']
-            each_student_info['Date '+str(k)] = each_student_info['Date']
-
-        for each_selected in selected_checkboxes:
-            pdf_path = each_selected + ".pdf"
-            obj = PDFParser(tmp_path=os.path.join(parent_directory, pdf_path), clean_up=True)
-
-            for x in file_list:
-                if x.name == pdf_path:
-                    pdf_path = str(x)
-                    print(pdf_path)
-
-            data = obj.get_field_data(pdf_path)
-            print(json.dumps(data))
-
-            new_pdf = obj.fill_pdf(pdf_path, each_student_info)
-            new_pdf = obj._write_tmp_file(bytestring=new_pdf)
-            each_student_merger.append(new_pdf)
-            files_to_delete.append(new_pdf)
-
-        each_student_merger.write(os.path.join(parent_directory, str(i) + ".pdf"))
-        each_student_merger.close()
-
-        student_files.append(os.path.join(parent_directory, str(i) + ".pdf"))
-        files_to_delete.append(os.path.join(parent_directory, str(i) + ".pdf"))
-
-        i = i + 1
-
-    for each_file in student_files:
-        merger.append(each_file)
+                items = enumerate(obj)
+                chunks, end = [b'['], b']'
+            for name, value in items:
+                value = self._canonical(value, digests)
+                if value is None:
+                    return None
+                chunks.append(str(name).encode('utf-8') + b' ' + value + b' ')
+            chunks.append(end)
+            if isinstance(obj, StreamObject):
+                chunks.append(b'stream ' + obj._data)
+            return b''.join(chunks)
+        buf = io.BytesIO()
+        obj.writeToStream(buf, None)
+        return buf.getvalue()
 
-    output_file = json_obj['outputFileName']
-    merger.write(os.path.join(parent_directory, output_file+".pdf"))
-    merger.close()
+    @property
+    def page_count(self):
+        return len(self._kids)
 
-    for each_file in files_to_delete:
-        try:
-            os.remove(each_file)
-        except:
-            pass
-    return jsonify({"status": "success", "filepath": output_file})
+    def finish(self):
+        """Return the page tree, catalog, xref table and trailer"""
+        chunks = []
+        pages = DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): self._kids,
+            NameObject('/Count'): NumberObject(len(self._kids)),
+        })
+        chunks.append(self._write_object(self._pages_num, pages))
+        catalog_num = self._reserve()
+        catalog = DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): self._ref(self._pages_num),
+        })
+        chunks.append(self._write_object(catalog_num, catalog))
+
+        xref_position = self._position
+        xref = [b'xref\n0 %d\n' % len(self._offsets), b'0000000000 65535 f \n']
+        xref.extend(b'%010d 00000 n \n' % offset for offset in self._offsets[1:])
+        xref.append(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+            len(self._offsets), catalog_num, xref_position))
+        chunks.append(self._emit(b''.join(xref)))
+        return b''.join(chunks)
+
+
+class PdfUpdateWriter(StreamingPdfWriter):
+    """Writes an incremental update for an existing pdf, to be appended to
+    it, that gives the document a new list of pages.
+
+    Pages are taken from the existing file by number with `add_existing`
+    or added from other documents with `add_document`. The existing pages
+    are left untouched, only the new pages, their objects, the page tree
+    and a new xref section pointing back at the old one are written.
+    """
+
+    def __init__(self, pdf_bytes, dedupe=False):
+        self._reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+        # only objects of the added documents are shared, not existing ones
+        self._shared = {} if dedupe else None
+        trailer = self._reader.trailer
+        self._offsets = [None] * int(trailer['/Size'])
+        self._position = len(pdf_bytes)
+        self._kids = ArrayObject()
+        self._root = dict.__getitem__(trailer, '/Root')
+        self._info = dict.get(trailer, '/Info')
+        self._pages_num = dict.__getitem__(trailer['/Root'], '/Pages').idnum
+        self._prev = int(pdf_bytes[pdf_bytes.rindex(b'startxref') + 9:].split()[0])
+
+    def add_existing(self, first, last):
+        """Keep pages `first` to `last` (exclusive) of the existing file"""
+        for index in range(first, last):
+            ref = self._reader.getPage(index).indirectRef
+            self._kids.append(self._ref(ref.idnum))
+
+    def finish(self):
+        """Return the page tree, xref section and trailer"""
+        pages = DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): self._kids,
+            NameObject('/Count'): NumberObject(len(self._kids)),
+        })
+        chunks = [self._write_object(self._pages_num, pages)]
+
+        xref_position = self._position
+        # readers such as PyPDF2 expect every section to start at object 0
+        xref = [b'xref\n0 1\n0000000000 65535 f \n']
+        written = [num for num, offset in enumerate(self._offsets) if offset is not None]
+        start = 0
+        while start < len(written):
+            end = start
+            while end + 1 < len(written) and written[end + 1] == written[end] + 1:
+                end += 1
+            xref.append(b'%d %d\n' % (written[start], end - start + 1))
+            xref.extend(b'%010d 00000 n \n' % self._offsets[num]
+                        for num in written[start:end + 1])
+            start = end + 1
+        info = b' /Info %d 0 R' % self._info.idnum if self._info is not None else b''
+        xref.append(b'trailer\n<< /Size %d /Root %d 0 R%s /Prev %d >>\nstartxref\n%d\n%%%%EOF\n' % (
+            len(self._offsets), self._root.idnum, info, self._prev, xref_position))
+        chunks.append(self._emit(b''.join(xref)))
+        return b''.join(chunks)
+
+
+class FieldPainter:
+    """Draws form field values and widget appearances into page content,
+    shared by OverlayTemplate and PdfFlattener.
+    """
+
+    FONT_NAME = NameObject('/FOvl')
+
+    def __init__(self):
+        self.font = DictionaryObject({
+            NameObject('/Type'): NameObject('/Font'),
+            NameObject('/Subtype'): NameObject('/Type1'),
+            NameObject('/BaseFont'): NameObject('/Helvetica'),
+            NameObject('/Encoding'): NameObject('/WinAnsiEncoding'),
+        })
+
+    def _font_size(self, da):
+        parts = (da or '').split()
+        if 'Tf' in parts:
+            try:
+                return float(parts[parts.index('Tf') - 1])
+            except (ValueError, IndexError):
+                pass
+        return 0
+
+    def _escape(self, value):
+        text = str(value).encode('cp1252', 'replace')
+        return text.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+    def _draw_text(self, rect, font_size, value):
+        llx, lly, urx, ury = min(rect[0], rect[2]), min(rect[1], rect[3]), \
+            max(rect[0], rect[2]), max(rect[1], rect[3])
+        height = ury - lly
+        size = font_size or min(10, height * 0.7)
+        y = lly + (height - size) / 2 + size * 0.22
+        return b'BT %s %.2f Tf 0 g %.2f %.2f Td (%s) Tj ET\n' % (
+            self.FONT_NAME.encode(), size, llx + 2, y, self._escape(value))
+
+    def _draw_appearance(self, annot, rect, value, xobjects):
+        """Draw the normal appearance of `annot`, the one for state `value`
+        when it has several, fitted to `rect` the way viewers place it
+        """
+        # dict.get would hand back the IndirectObjects unresolved
+        ap = annot['/AP'] if '/AP' in annot else None
+        appearances = ap['/N'] if ap is not None and '/N' in ap else None
+        if appearances is None:
+            return b''
+        if isinstance(appearances, StreamObject):
+            appearance = ap.raw_get('/N')
+        elif value is not None and ('/' + value) in appearances:
+            appearance = appearances.raw_get('/' + value)
+        else:
+            return b''
+        form = appearance.getObject()
+        bbox = [float(v) for v in (form['/BBox'] if '/BBox' in form else [0, 0, 0, 0])]
+        a, b, c, d, e, f = [float(v) for v in
+                            (form['/Matrix'] if '/Matrix' in form else [1, 0, 0, 1, 0, 0])]
+        corners = [(a * x + c * y + e, b * x + d * y + f)
+                   for x in (bbox[0], bbox[2]) for y in (bbox[1], bbox[3])]
+        x0, y0 = min(x for x, _ in corners), min(y for _, y in corners)
+        x1, y1 = max(x for x, _ in corners), max(y for _, y in corners)
+        llx, lly = min(rect[0], rect[2]), min(rect[1], rect[3])
+        sx = abs(rect[2] - rect[0]) / (x1 - x0) if x1 > x0 else 1
+        sy = abs(rect[3] - rect[1]) / (y1 - y0) if y1 > y0 else 1
+        name = NameObject('/XOvl%d' % len(xobjects))
+        xobjects[name] = appearance
+        return b'q %.4f 0 0 %.4f %.2f %.2f cm %s Do Q\n' % (
+            sx, sy, llx - x0 * sx, lly - y0 * sy, name.encode())
+
+    def _stream(self, writer, data):
+        stream = DecodedStreamObject()
+        stream.setData(data)
+        return writer._addObject(stream)
+
+    def _add_page(self, writer, reader, page, ops, xobjects, annots):
+        """Add a copy of `page` to `writer` with `ops` drawn over its
+        content and only `annots` left as annotations
+        """
+        new_page = PageObject(reader)
+        for key, value in dict.items(page):
+            if key not in ('/Parent', '/Contents', '/Resources', '/Annots'):
+                dict.__setitem__(new_page, key, value)
+
+        resources = DictionaryObject(page.get('/Resources') or {})
+        fonts = DictionaryObject(resources.get('/Font') or {})
+        fonts[self.FONT_NAME] = self.font
+        resources[NameObject('/Font')] = fonts
+        if xobjects:
+            page_xobjects = DictionaryObject(resources.get('/XObject') or {})
+            page_xobjects.update(xobjects)
+            resources[NameObject('/XObject')] = page_xobjects
+        new_page[NameObject('/Resources')] = resources
+
+        contents = page.raw_get('/Contents') if '/Contents' in page else None
+        if isinstance(contents, IndirectObject) and isinstance(contents.getObject(), ArrayObject):
+            contents = contents.getObject()
+        if contents is None:
+            contents = ArrayObject()
+        elif not isinstance(contents, ArrayObject):
+            contents = ArrayObject([contents])
+        new_page[NameObject('/Contents')] = ArrayObject(
+            [self._stream(writer, b'q\n')] + list(contents) +
+            [self._stream(writer, b'Q\n' + b''.join(ops))])
+
+        if annots:
+            new_page[NameObject('/Annots')] = ArrayObject(annots)
+        writer.addPage(new_page)
+
+
+class OverlayTemplate(FieldPainter):
+    """A checklist template parsed once and reused for every student.
+
+    `add_pages` puts the template's pages into a writer with only the given
+    answers drawn on top, so the pages share the template's content streams,
+    fonts and images instead of carrying a filled copy of the whole form.
+    Widgets that get a value drawn are left out of the page, the others are
+    kept as they are in the template, or drawn as well when flattening.
+    """
+
+    def __init__(self, pdf_path):
+        super().__init__()
+        with open(pdf_path, 'rb') as f:
+            self.reader = PdfFileReader(io.BytesIO(f.read()), strict=False)
+        fields = PyPDF2Backend()
+        self.pages = []
+        for page in self.reader.pages:
+            widgets = {}
+            for annot_ref in page.get('/Annots') or []:
+                annot = annot_ref.getObject()
+                if annot.get('/Subtype') != '/Widget':
+                    continue
+                field = annot if '/T' in annot else fields._parent(annot)
+                if field is None:
+                    continue
+                # widgets are shared by every student's copy of the page
+                if '/P' in annot:
+                    del annot['/P']
+                widgets.setdefault(fields._full_name(field), []).append((
+                    annot_ref,
+                    [float(v) for v in annot['/Rect']],
+                    fields._field_type(field),
+                    self._font_size(fields._inherited(field, '/DA')),
+                ))
+            self.pages.append((page, widgets))
+
+    def add_pages(self, writer, answers, flatten=False):
+        """Add this template's pages to `writer` with `answers` drawn on
+        them. With `flatten` the widgets without an answer are drawn as
+        they appear in the template and no widget is kept.
+        """
+        for page, widgets in self.pages:
+            ops = []
+            xobjects = {}
+            drawn = set()
+            for name, entries in widgets.items():
+                if name not in answers:
+                    continue
+                value = answers[name]
+                for annot_ref, rect, kind, font_size in entries:
+                    if kind in ('checkbox', 'radio button'):
+                        ops.append(self._draw_appearance(
+                            annot_ref.getObject(), rect, str(value), xobjects))
+                    else:
+                        ops.append(self._draw_text(rect, font_size, value))
+                    drawn.add(annot_ref.idnum)
+
+            annots = []
+            for annot_ref in page.get('/Annots') or []:
+                if annot_ref.idnum in drawn:
+                    continue
+                annot = annot_ref.getObject()
+                if flatten and annot.get('/Subtype') == '/Widget':
+                    if not int(annot.get('/F', 0)) & PdfFlattener.HIDDEN:
+                        state = annot.get('/AS')
+                        ops.append(self._draw_appearance(
+                            annot, [float(v) for v in annot['/Rect']],
+                            state[1:] if state else None, xobjects))
+                    continue
+                annots.append(annot_ref)
+            self._add_page(writer, self.reader, page, ops, xobjects, annots)
+
+
+class PdfFlattener(FieldPainter):
+    """Turns a filled form into plain pages: every widget's value is drawn
+    into the page content and the widgets and the AcroForm are dropped.
+
+    Widgets are drawn from their appearance stream, except text and choice
+    fields of a form that asks viewers to build appearances
+    (/NeedAppearances, as the pypdf2 backend does), whose value is drawn
+    as text instead.
+    """
+
+    HIDDEN = 1 << 1
+
+    def __init__(self):
+        super().__init__()
+        self.fields = PyPDF2Backend()
+
+    def flatten(self, pdf_bytes):
+        """Return `pdf_bytes` flattened"""
+        reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+        acro_form = reader.trailer['/Root'].get('/AcroForm')
+        need_appearances = acro_form is not None and \
+            bool(acro_form.getObject().get('/NeedAppearances'))
+        writer = PdfFileWriter()
+        for page in reader.pages:
+            ops = []
+            xobjects = {}
+            annots = []
+            for annot_ref in page.get('/Annots') or []:
+                annot = annot_ref.getObject()
+                if annot.get('/Subtype') != '/Widget':
+                    annots.append(annot_ref)
+                    continue
+                if int(annot.get('/F', 0)) & self.HIDDEN:
+                    continue
+                ops.append(self._draw_widget(annot, need_appearances, xobjects))
+            self._add_page(writer, reader, page, ops, xobjects, annots)
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
+
+    def _draw_widget(self, annot, need_appearances, xobjects):
+        rect = [float(v) for v in annot['/Rect']]
+        field = annot if '/T' in annot else self.fields._parent(annot)
+        kind = self.fields._field_type(field) if field is not None else 'unknown'
+        ap = annot['/AP'] if '/AP' in annot else None
+        has_appearance = ap is not None and '/N' in ap and isinstance(ap['/N'], StreamObject)
+        if kind in ('text', 'combo box', 'listbox') and (need_appearances or not has_appearance):
+            value = self.fields._inherited(field, '/V')
+            if isinstance(value, list):
+                value = ', '.join(str(v) for v in value)
+            if value is None or value == '':
+                return b''
+            return self._draw_text(
+                rect, self._font_size(self.fields._inherited(field, '/DA')), value)
+        state = annot.get('/AS')
+        return self._draw_appearance(annot, rect, state[1:] if state else None, xobjects)
+
+
+def flatten_pdf(pdf_bytes):
+    """Return the filled pdf `pdf_bytes` with its fields baked into the pages"""
+    with metrics.span('flatten'):
+        return PdfFlattener().flatten(pdf_bytes)
+
+
+def concat_pdfs(documents):
+    """Join pdf documents given as bytes into one, in process"""
+    writer = StreamingPdfWriter()
+    chunks = [writer.header()]
+    chunks.extend(writer.add_document(document) for document in documents)
+    chunks.append(writer.finish())
+    return b''.join(chunks)
+
+
+_overlay_templates = {}
+
+
+def get_overlay_template(pdf_path):
+    """Return the OverlayTemplate of `pdf_path`, parsed once per process and
+    again whenever the file changes
+    """
+    key = (os.path.abspath(pdf_path), os.stat(pdf_path).st_mtime_ns)
+    template = _overlay_templates.get(key)
+    if template is None:
+        template = _overlay_templates[key] = OverlayTemplate(pdf_path)
+    return template
+
+
+def get_render_mode():
+    """'fill' fills every checklist through the pdf backend, 'overlay'
+    stamps the answers onto precompiled templates
+    """
+    return os.environ.get('RENDER_MODE', 'fill')
+
+
+def get_merge_mode():
+    """'plain' merges packets with PdfFileMerger, 'dedupe' writes objects
+    the merged documents have in common only once
+    """
+    return os.environ.get('MERGE_MODE', 'plain')
+
+
+def write_merged(output, segments):
+    """Merge `segments`, lists of pdf documents given as bytes or file
+    paths, into the file object `output` and return the [first, last) page
+    range of every segment
+    """
+    pages = []
+    if get_merge_mode() == 'dedupe':
+        writer = StreamingPdfWriter(dedupe=True)
+        output.write(writer.header())
+        for documents in segments:
+            start = writer.page_count
+            for document in documents:
+                if not isinstance(document, bytes):
+                    with open(document, 'rb') as f:
+                        document = f.read()
+                with metrics.span('merge'):
+                    output.write(writer.add_document(document))
+            pages.append([start, writer.page_count])
+        with metrics.span('write'):
+            output.write(writer.finish())
+        return pages
+    merger = PdfFileMerger()
+    for documents in segments:
+        start = len(merger.pages)
+        for document in documents:
+            with metrics.span('merge'):
+                merger.append(io.BytesIO(document) if isinstance(document, bytes) else document)
+        pages.append([start, len(merger.pages)])
+    with metrics.span('write'):
+        merger.write(output)
+    merger.close()
+    return pages
+
+
+# where the course template folders live and the packets are written,
+# create_app() sets it from the PARENT_DIRECTORY config
+parent_directory = os.environ.get('PARENT_DIRECTORY', './')
+
+bp = Blueprint('flaskapp', __name__)
+
+
+@bp.route('/', methods=['GET'])
+def show_html():
+    file_list = get_template_catalog().file_names()
+    logger.debug("templates: %s", file_list)
+    return render_template('index_newmilestone4.html', data=file_list)
+
+
+@bp.route('/download', methods=['POST'])
+def download():
+    json_obj = request.get_json()
+    logger.debug("download %s", json_obj['filename'])
+    if 'students' in json_obj:
+        try:
+            first, last = parse_student_range(json_obj['students'])
+        except ValueError:
+            abort(400)
+        return send_students(json_obj['filename'], first, last)
+    # return jsonify({"status": "success", "filepath": ""})
+    # return send_from_directory(directory=parent_directory, filename=json_obj['filename']+".pdf")
+    return send_file(os.path.abspath(assemble_packet(json_obj['filename'])), as_attachment=True)
+    # with open(os.path.join(parent_directory, json_obj['filename']+".pdf")) as f:
+    #     data = f.read()
+    # resp = Response(data, mimetype="application/octet-stream")
+    # resp.headers["Content-Length"] = os.path.getsize(os.path.join(parent_directory, json_obj['filename']+".pdf"))
+    # resp.headers["Content-Disposition"] = "attachment; filename=%s" % os.path.basename(os.path.join(parent_directory, json_obj['filename']+".pdf"))
+    # return resp
+
+
+@bp.route('/download/<filename>', methods=['GET'])
+def download_packet(filename):
+    """GET counterpart of /download for `<filename>.pdf`. Sends ETag and
+    Last-Modified, answers If-None-Match/If-Modified-Since with 304 and
+    serves Range requests, so repeat and interrupted downloads only move
+    what is missing. ?students=2-5 selects students like /download does.
+    """
+    if not filename or filename != os.path.basename(filename) or filename.startswith('.'):
+        abort(404)
+    students = request.args.get('students')
+    if students is not None:
+        try:
+            first, last = parse_student_range(students)
+        except ValueError:
+            abort(400)
+        return send_students(filename, first, last)
+    packet_path = os.path.abspath(assemble_packet(filename))
+    if not os.path.isfile(packet_path):
+        abort(404)
+    # the file goes out through wsgi.file_wrapper (sendfile under mod_wsgi
+    # and gunicorn) or X-Sendfile, never through a python read loop
+    return send_file(packet_path, mimetype='application/pdf', as_attachment=True,
+                     conditional=True)
+
+
+def send_students(output_file, first, last):
+    """Respond with students `first` to `last` of a rendered packet. The
+    ETag comes from the students' segment fingerprints so a revalidation
+    is answered without extracting anything.
+    """
+    packet_path = os.path.join(parent_directory, output_file+".pdf")
+    index = packet_index.load(packet_path)
+    etag = None
+    if index is not None:
+        segments = [segment for segment in index['segments'] if segment['segment'] != 'course']
+        if last >= len(segments):
+            abort(404)
+        fingerprints = [segment['fingerprint'] for segment in segments[first:last + 1]]
+        if fingerprints and None not in fingerprints:
+            etag = hashlib.sha1('{}-{}:{}'.format(
+                first, last, ','.join(fingerprints)).encode('utf-8')).hexdigest()
+    if etag is not None and request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+    data = extract_students(output_file, first, last)
+    if data is None:
+        abort(404)
+    if etag is None:
+        etag = hashlib.sha1(data).hexdigest()
+    return send_file(io.BytesIO(data), mimetype='application/pdf', as_attachment=True,
+                     download_name='{}-students-{}-{}.pdf'.format(output_file, first, last),
+                     etag=etag, conditional=True)
+
+
+def parse_student_range(students):
+    """Turn a student index (3 or "3") or an inclusive range ("2-5" or
+    [2, 5]) into a (first, last) pair
+    """
+    if isinstance(students, list):
+        if len(students) != 2:
+            raise ValueError("expected [first, last], got {!r}".format(students))
+        first, last = students
+    elif isinstance(students, str) and '-' in students.strip('-'):
+        first, _, last = students.partition('-')
+    else:
+        first = last = students
+    for value in (first, last):
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError("bad student index {!r}".format(value))
+    first, last = int(first), int(last)
+    if first < 0 or last < first:
+        raise ValueError("bad student range {}-{}".format(first, last))
+    return first, last
+
+
+def render_student(pdf_paths, answers, scratch_dir=None, flatten=False):
+    """Fill every checklist of one student and return them merged as bytes.
+    This runs in the render process pool, so it only takes plain data.
+    """
+    with metrics.span('render_student'):
+        return _render_student(pdf_paths, answers, scratch_dir, flatten)
+
+
+def _render_student(pdf_paths, answers, scratch_dir, flatten):
+    if get_render_mode() == 'overlay':
+        writer = PdfFileWriter()
+        for pdf_path in pdf_paths:
+            get_overlay_template(pdf_path).add_pages(writer, answers, flatten)
+        student_file = io.BytesIO()
+        writer.write(student_file)
+        return student_file.getvalue()
+
+    logger.debug("filling %s", pdf_paths)
+    obj = PDFParser(tmp_path=scratch_dir, clean_up=True)
+    return obj.fill_batch([(pdf_path, answers) for pdf_path in pdf_paths],
+                          concatenate=True, flatten=flatten)
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def _init_render_process():
+    # the render processes already use every core, one pdfparser worker each
+    os.environ['PDFPARSER_POOL_SIZE'] = '1'
+
+
+def get_render_processes():
+    return int(os.environ.get('RENDER_PROCESSES', 0)) or os.cpu_count() or 1
+
+
+def get_render_pool():
+    """Return the process pool used to fill checklists, or None when
+    RENDER_PROCESSES is 1 and everything runs in the calling process
+    """
+    global _render_pool
+    processes = get_render_processes()
+    if processes <= 1:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_render_process)
+        return _render_pool
+
+
+def render_checklist(pdf_path, answers, scratch_dir=None, flatten=False):
+    """Fill a single checklist and return it as bytes, the per-checklist
+    counterpart of render_student
+    """
+    obj = PDFParser(tmp_path=scratch_dir, clean_up=True)
+    logger.debug("filling %s", pdf_path)
+    if log_sampled(logging.DEBUG):
+        logger.debug("fields of %s: %s", pdf_path, json.dumps(obj.get_field_data(pdf_path)))
+        logger.debug("answers for %s: %s", pdf_path, json.dumps(answers))
+    return obj.fill_pdf(pdf_path, answers, flatten)
+
+
+# What a render worker may run for the web processes. Every task is called
+# as func(inputs, answers, scratch_dir, flatten) and returns pdf bytes; the
+# scratch_dir is always the worker's own.
+RENDER_TASKS = {
+    'render_student': render_student,
+    'render_checklist': render_checklist,
+}
+
+
+class RenderTaskError(Exception):
+    pass
+
+
+class SqliteBroker:
+    """A render task queue in a SQLite database. Every process opening the
+    same file shares the queue, which is enough for workers on one host
+    or on hosts sharing a filesystem with working locks.
+
+    A claimed task that is not finished within `lease` seconds goes back
+    to the queue, so tasks of a worker that died are picked up by another.
+    """
+
+    def __init__(self, path, lease):
+        self.path = path
+        self.lease = lease
+        self._local = threading.local()
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, task TEXT, args TEXT,"
+            " state TEXT, claimed_at REAL, result BLOB, error TEXT)")
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def put(self, task, args):
+        task_id = uuid.uuid4().hex
+        self._db().execute("INSERT INTO tasks (id, task, args, state) VALUES (?, ?, ?, 'queued')",
+                           (task_id, task, json.dumps(args)))
+        return task_id
+
+    def claim(self):
+        """Return the (task_id, task, args) of the oldest waiting task and
+        mark it as running, or None when there is nothing to do
+        """
+        db = self._db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT id, task, args FROM tasks WHERE state = 'queued'"
+                " OR (state = 'running' AND claimed_at < ?) ORDER BY rowid LIMIT 1",
+                (now - self.lease,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE tasks SET state = 'running', claimed_at = ? WHERE id = ?",
+                           (now, row[0]))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def complete(self, task_id, result):
+        self._db().execute("UPDATE tasks SET state = 'done', result = ? WHERE id = ?",
+                           (result, task_id))
+
+    def fail(self, task_id, error):
+        self._db().execute("UPDATE tasks SET state = 'failed', error = ? WHERE id = ?",
+                           (error, task_id))
+
+    def poll(self, task_id):
+        """Return the result of a finished task, None while it is pending"""
+        row = self._db().execute("SELECT state, result, error FROM tasks WHERE id = ?",
+                                 (task_id,)).fetchone()
+        if row is None:
+            raise RenderTaskError("render task {} is gone".format(task_id))
+        if row[0] == 'failed':
+            raise RenderTaskError(row[2])
+        return bytes(row[1]) if row[0] == 'done' else None
+
+    def discard(self, task_id):
+        self._db().execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+
+class DirectoryBroker:
+    """A render task queue kept as files in a directory, for hosts that
+    share a filesystem (NFS and the like) but not SQLite locking. Tasks
+    move from queued/ to running/ by rename, which only one claimant wins.
+    The claim time is part of the running/ name, see SqliteBroker for
+    `lease`.
+    """
+
+    def __init__(self, path, lease):
+        self.path = path
+        self.lease = lease
+        for name in ('queued', 'running', 'done'):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+
+    def _write(self, path, data):
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put(self, task, args):
+        # ids sort in submission order
+        task_id = '{:020d}-{}'.format(time.time_ns(), uuid.uuid4().hex)
+        self._write(os.path.join(self.path, 'queued', task_id + '.json'),
+                    json.dumps({'task': task, 'args': args}).encode('utf-8'))
+        return task_id
+
+    def _requeue_expired(self):
+        running = os.path.join(self.path, 'running')
+        for name in os.listdir(running):
+            task_id, _, claimed_at = name.rpartition('@')
+            if claimed_at.isdigit() and int(claimed_at) < (time.time() - self.lease) * 1e9:
+                try:
+                    os.replace(os.path.join(running, name),
+                               os.path.join(self.path, 'queued', task_id + '.json'))
+                except FileNotFoundError:
+                    pass
+
+    def claim(self):
+        self._requeue_expired()
+        queued = os.path.join(self.path, 'queued')
+        for name in sorted(os.listdir(queued)):
+            if not name.endswith('.json'):
+                continue
+            task_id = name[:-len('.json')]
+            running_path = os.path.join(
+                self.path, 'running', '{}@{}'.format(task_id, time.time_ns()))
+            try:
+                os.replace(os.path.join(queued, name), running_path)
+            except FileNotFoundError:
+                # another worker was faster
+                continue
+            with open(running_path, 'rb') as f:
+                message = json.loads(f.read().decode('utf-8'))
+            return task_id, message['task'], message['args']
+        return None
+
+    def _finish(self, task_id, suffix, data):
+        self._write(os.path.join(self.path, 'done', task_id + suffix), data)
+        running = os.path.join(self.path, 'running')
+        for name in os.listdir(running):
+            if name.startswith(task_id + '@'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(running, name))
+
+    def complete(self, task_id, result):
+        self._finish(task_id, '.pdf', result)
+
+    def fail(self, task_id, error):
+        self._finish(task_id, '.error', error.encode('utf-8'))
+
+    def poll(self, task_id):
+        done = os.path.join(self.path, 'done', task_id)
+        try:
+            with open(done + '.error', 'rb') as f:
+                raise RenderTaskError(f.read().decode('utf-8'))
+        except FileNotFoundError:
+            pass
+        try:
+            with open(done + '.pdf', 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def discard(self, task_id):
+        for path in (os.path.join(self.path, 'queued', task_id + '.json'),
+                     os.path.join(self.path, 'done', task_id + '.pdf'),
+                     os.path.join(self.path, 'done', task_id + '.error')):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+# RENDER_BROKER scheme -> broker class, taking (path, lease). Another queue
+# (redis, a message broker, ...) plugs in by adding a class with the same
+# put / claim / complete / fail / poll / discard methods here.
+RENDER_BROKERS = {
+    'sqlite': SqliteBroker,
+    'dir': DirectoryBroker,
+}
+
+_render_broker = None
+_render_broker_lock = threading.Lock()
+
+
+def get_render_broker():
+    """Return the task queue shared with render workers, or None when
+    RENDER_BROKER is not set and rendering stays on this host. RENDER_BROKER
+    is 'sqlite:///path/to/queue.db' or 'dir:///path/to/queue/'.
+    """
+    global _render_broker
+    url = os.environ.get('RENDER_BROKER')
+    if not url:
+        return None
+    with _render_broker_lock:
+        if _render_broker is None or _render_broker[0] != url:
+            scheme, _, path = url.partition('://')
+            if scheme not in RENDER_BROKERS or not path:
+                raise InvalidOptionError("unsupported RENDER_BROKER {!r}".format(url))
+            lease = float(os.environ.get('RENDER_TASK_LEASE', 300))
+            _render_broker = (url, RENDER_BROKERS[scheme](path, lease))
+        return _render_broker[1]
+
+
+def _broker_result(broker, task_id, timeout):
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while True:
+        result = broker.poll(task_id)
+        if result is not None:
+            return result
+        if time.monotonic() > deadline:
+            raise RenderTaskError(
+                "no render worker finished task {} within {} s".format(task_id, timeout))
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+
+def _broker_map(broker, func, tasks):
+    window = int(os.environ.get('RENDER_BROKER_WINDOW', 64))
+    timeout = float(os.environ.get('RENDER_TASK_TIMEOUT', 600))
+    pending = collections.deque()
+    try:
+        for inputs, answers, _scratch_dir, flatten in tasks:
+            pending.append(broker.put(func.__name__, [inputs, answers, flatten]))
+            if len(pending) >= window:
+                task_id = pending[0]
+                yield _broker_result(broker, task_id, timeout)
+                pending.popleft()
+                broker.discard(task_id)
+        while pending:
+            task_id = pending[0]
+            yield _broker_result(broker, task_id, timeout)
+            pending.popleft()
+            broker.discard(task_id)
+    finally:
+        # nobody is waiting for these any more
+        for task_id in pending:
+            broker.discard(task_id)
+
+
+def render_map(func, tasks):
+    """Like map(func, *zip(*tasks)) on the render pool, or on the render
+    workers when RENDER_BROKER is set, results are yielded in the order of
+    `tasks`. `tasks` is consumed as the pool makes room, so it can be a
+    generator that is still reading its input.
+    """
+    broker = get_render_broker()
+    if broker is not None:
+        yield from _broker_map(broker, func, tasks)
+        return
+    pool = get_render_pool()
+    if pool is None:
+        for task in tasks:
+            yield func(*task)
+        return
+    # enough in flight to keep every process busy, no more
+    window = 2 * get_render_processes()
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.submit(func, *task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def run_render_worker(processes=None, poll_interval=0.2):
+    """Take render tasks from the RENDER_BROKER queue and run them until
+    interrupted, `processes` (RENDER_PROCESSES by default) at a time. The
+    worker needs the same templates at the same paths, and the same
+    RENDER_MODE and PDFPARSER_BACKEND, as the web processes.
+    """
+    broker = get_render_broker()
+    if broker is None:
+        raise InvalidOptionError("RENDER_BROKER is not set")
+    processes = processes or get_render_processes()
+    if processes > 1:
+        os.environ['RENDER_PROCESSES'] = str(processes)
+    pool = get_render_pool()
+    stop = threading.Event()
+
+    def work():
+        while not stop.is_set():
+            claimed = broker.claim()
+            if claimed is None:
+                stop.wait(poll_interval)
+                continue
+            task_id, task, (inputs, answers, flatten) = claimed
+            started_at = time.perf_counter()
+            try:
+                func = RENDER_TASKS[task]
+                with ScratchSpace() as scratch:
+                    args = (inputs, answers, scratch.directory, flatten)
+                    result = pool.submit(func, *args).result() if pool else func(*args)
+            except Exception as e:
+                logger.exception("render task %s failed", task_id)
+                broker.fail(task_id, '{}: {}'.format(type(e).__name__, e))
+                continue
+            broker.complete(task_id, result)
+            logger.info("rendered %s %s in %.2f s", task, task_id,
+                        time.perf_counter() - started_at)
+
+    logger.info("render worker taking tasks from %s with %d processes",
+                os.environ['RENDER_BROKER'], processes)
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(processes)]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+ROSTER_TEMPLATE = "2020 Guidelines BLS Course Roster_ucm_506772_unlocked (1)"
+
+
+# How the keys of a /submit payload become pdf field names.
+#
+#   indexed:  form key prefix -> field. '<prefix>-0' fills '<field>' and
+#             '<prefix>-<n>' fills '<field> <n+1>'
+#   aliases:  field -> the course field whose value it repeats
+#   student:  field -> key of the student's entry in 'student-info'
+#   course:   course fields every student checklist repeats
+#   repeated: fields that are copied to each '<field> <k>' the template has
+COMMON_FIELD_MAPPING = {
+    'indexed': {
+        'assis-name': 'Name-Instructor ID',
+        'assis-card-exp': 'Card Exp Date',
+        'cp-name': 'Name',
+        'cp-mailing': 'Mailing Address',
+        'cp-email': 'Email',
+        'cp-phone': 'Telephone',
+        'cp-psa': 'PSA',
+        'cp-comp-imcomp': 'Complete-Incomplete',
+        'cp-remed': 'Remediation',
+    },
+    'aliases': {},
+    'student': {
+        'Student Name': 'cp-name',
+        'Date of Test': 'cp-dot',
+    },
+    'course': ('Instructor Initials', 'Instructor Number', 'Date'),
+    'repeated': ('Student Name', 'Date of Test', 'Instructor Initials',
+                 'Instructor Number', 'Date'),
+}
+
+FIELD_MAPPINGS = {
+    'ACLS': COMMON_FIELD_MAPPING,
+    'BLS': dict(COMMON_FIELD_MAPPING, aliases={
+        # the BLS roster repeats the signature block on its second page
+        'Signature': 'Lead Instructor Signature',
+        'Date 2': 'Date',
+        'Lead Instructor 2': 'Lead Instructor',
+        'Lead Instructor ID# 2': 'Lead Instructor ID#',
+        'Card Expriation Date': 'Card Expiration Date',
+    }),
+    'PALS': COMMON_FIELD_MAPPING,
+}
+
+# used for templates that are not in the catalog
+DEFAULT_FIELD_MAPPING = FIELD_MAPPINGS['BLS']
+
+# copies made when a template's fields cannot be read
+DEFAULT_REPEAT_COUNT = 13
+
+
+class FieldMapper:
+    """A field mapping table compiled into lookups. Indexed form keys are
+    resolved with one dict lookup, and repeated fields are only expanded
+    into the numbered copies the target template actually has.
+    """
+
+    def __init__(self, table):
+        self.indexed = dict(table['indexed'])
+        self.aliases = tuple(table['aliases'].items())
+        self.student = tuple(table['student'].items())
+        self.course = tuple(table['course'])
+        self.repeated = frozenset(table['repeated'])
+        self._copies = {}
+        self._lock = threading.Lock()
+
+    def field_name(self, key):
+        """Return the pdf field a payload key fills, or the key itself when
+        it is not an indexed form key
+        """
+        prefix, _, index = key.rpartition('-')
+        field = self.indexed.get(prefix)
+        if field is None or not index.isdigit():
+            return key
+        if index == '0':
+            return field
+        return '{} {}'.format(field, int(index) + 1)
+
+    def course_answers(self, json_obj):
+        """Answers for the course level forms of a payload"""
+        answers = dict(json_obj['courseInfo'])
+        for key, value in json_obj['assistingInstructors'].items():
+            answers[self.field_name(key)] = value
+        answers.update(json_obj['courseParticipants'])
+        for field, source in self.aliases:
+            answers[field] = answers[source]
+        for key, value in json_obj['courseParticipants1'].items():
+            if key != 'student-info':
+                answers[self.field_name(key)] = value
+        return answers
+
+    def student_answers(self, each_obj, course_answers, copies=(), answers=None):
+        """Add the answers of one student's checklist to `answers` and
+        return it. `copies` comes from `copies(pdf_path)` of the checklist.
+        """
+        if answers is None:
+            answers = {}
+        for field, key in self.student:
+            answers[field] = each_obj[key]
+        for field in self.course:
+            answers[field] = course_answers[field]
+        for copy_name, field in copies:
+            answers[copy_name] = answers[field]
+        return answers
+
+    def copies(self, pdf_path):
+        """Return the (numbered field, field) pairs of `pdf_path`"""
+        try:
+            key = field_schema_cache.key(pdf_path)
+        except OSError:
+            key = None
+        copies = self._copies.get(key)
+        if copies is None:
+            copies = self._compile_copies(pdf_path if key else None)
+            with self._lock:
+                self._copies[key] = copies
+        return copies
+
+    def _compile_copies(self, pdf_path):
+        if pdf_path is None:
+            return tuple(('{} {}'.format(field, k), field)
+                         for k in range(DEFAULT_REPEAT_COUNT) for field in self.repeated)
+        copies = []
+        for name in sorted(PDFParser().get_template(pdf_path).names):
+            field, _, index = name.rpartition(' ')
+            if field in self.repeated and index.isdigit():
+                copies.append((name, field))
+        return tuple(copies)
+
+
+_field_mappers = {}
+
+
+def get_field_mapper(course):
+    """Return the compiled FieldMapper for course type `course`"""
+    mapper = _field_mappers.get(course)
+    if mapper is None:
+        mapper = _field_mappers[course] = FieldMapper(
+            FIELD_MAPPINGS.get(course, DEFAULT_FIELD_MAPPING))
+    return mapper
+
+
+def build_packet_tasks(json_obj):
+    """Work out what a /submit payload asks for. Returns a list of
+    (pdf_path, answers) for the course level forms and a list of
+    (student_name, pdf_paths, answers) with one entry per student.
+    """
+    tasks = PacketTasks(json_obj)
+    student_tasks = [tasks.student_task(each_obj)
+                     for each_obj in json_obj['courseParticipants1']['student-info']]
+    return tasks.course_tasks(json_obj), student_tasks
+
+
+class PacketTasks:
+    """build_packet_tasks one student at a time, for rosters that are read
+    while they render. Every checklist is looked up once, not once per
+    student.
+    """
+
+    def __init__(self, json_obj):
+        self.catalog = get_template_catalog()
+        self.selected_options = [name for name in json_obj['selectedOptions']
+                                 if name != ROSTER_TEMPLATE]
+        self.course_answers = get_field_mapper(None).course_answers(json_obj)
+        self._templates = {}
+
+    def template(self, name):
+        entry = self._templates.get(name)
+        if entry is None:
+            pdf_path = self.catalog.get(name) or name + ".pdf"
+            mapper = get_field_mapper(self.catalog.course_of(name))
+            entry = self._templates[name] = (pdf_path, mapper, mapper.copies(pdf_path))
+        return entry
+
+    def course_tasks(self, json_obj):
+        """The (pdf_path, answers) of the course level forms, which need
+        every student of the roster in json_obj['courseParticipants1']
+        """
+        if ROSTER_TEMPLATE not in json_obj['selectedOptions']:
+            return []
+        mapper = get_field_mapper(self.catalog.course_of(ROSTER_TEMPLATE))
+        pdf_path = self.catalog.get(ROSTER_TEMPLATE) or ROSTER_TEMPLATE + ".pdf"
+        return [(pdf_path, mapper.course_answers(json_obj))]
+
+    def student_task(self, each_obj):
+        """The (student_name, pdf_paths, answers) of one 'student-info' entry"""
+        each_student_info = {}
+        pdf_paths = []
+        for each_selected in self.selected_options + each_obj['selected-checkboxes']:
+            pdf_path, mapper, copies = self.template(each_selected)
+            mapper.student_answers(each_obj, self.course_answers, copies, each_student_info)
+            pdf_paths.append(pdf_path)
+        return (each_obj['cp-name'], pdf_paths, each_student_info)
+
+
+class PacketCache:
+    """Keeps rendered packets on disk so a payload that was already rendered
+    is served without filling anything again.
+
+    Entries are keyed by a hash of the canonical payload together with the
+    content hashes of the templates it selects, so editing a template makes
+    every packet built from it miss. Least recently used entries are
+    dropped once the cache holds more than `max_bytes`.
+    """
+
+    # payload keys that do not change the rendered pdf
+    IGNORED_KEYS = ('outputFileName', 'stream')
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._templates = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self):
+        # pick up entries left by an earlier run, oldest first
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            names = [name for name in os.listdir(self.cache_dir) if name.endswith('.pdf')]
+        except OSError:
+            return
+        paths = [os.path.join(self.cache_dir, name) for name in names]
+        for path in sorted(paths, key=os.path.getmtime):
+            size = os.path.getsize(path)
+            self._entries[os.path.basename(path)[:-4]] = (size, {})
+            self._size += size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pdf')
+
+    def key(self, payload):
+        """Return the cache key of a /submit payload, or None when it
+        cannot be cached
+        """
+        if not self.cache_dir:
+            return None
+        catalog = get_template_catalog()
+        names = list(payload.get('selectedOptions', []))
+        students = payload.get('courseParticipants1', {}).get('student-info', [])
+        for each_obj in students:
+            names.extend(each_obj.get('selected-checkboxes', []))
+        # an imported roster lists its checklists in the file
+        names.extend(payload.get('rosterChecklists', []))
+        templates = {}
+        try:
+            for name in names:
+                pdf_path = os.path.abspath(catalog.get(name) or name + ".pdf")
+                templates[pdf_path] = field_schema_cache.key(pdf_path)[2]
+        except OSError:
+            return None
+        canonical = {k: v for k, v in payload.items() if k not in self.IGNORED_KEYS}
+        sha = hashlib.sha1()
+        sha.update(json.dumps(canonical, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        sha.update(json.dumps(sorted(templates.items())).encode('utf-8'))
+        sha.update('{}:{}:{}'.format(
+            get_render_mode(), os.environ.get('PDFPARSER_BACKEND', 'jar'),
+            get_merge_mode()).encode('utf-8'))
+        with self._lock:
+            self._load()
+            for pdf_path, digest in templates.items():
+                if self._templates.get(pdf_path, digest) != digest:
+                    self._invalidate(pdf_path, digest)
+                self._templates[pdf_path] = digest
+        return (sha.hexdigest(), templates)
+
+    def _invalidate(self, pdf_path, digest):
+        # the template changed, nothing rendered from the old one can hit
+        for key, (size, templates) in list(self._entries.items()):
+            if templates.get(pdf_path, digest) != digest:
+                self._remove(key)
+
+    def _remove(self, key):
+        size, _ = self._entries.pop(key)
+        self._size -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """Return the path of the cached packet for `key`, or None"""
+        if key is None:
+            return None
+        digest = key[0]
+        with self._lock:
+            if digest not in self._entries:
+                metrics.inc('flaskapp_packet_cache_requests_total', {'result': 'miss'})
+                return None
+            path = self._path(digest)
+            if not os.path.exists(path):
+                self._remove(digest)
+                return None
+            self._entries.move_to_end(digest)
+        metrics.inc('flaskapp_packet_cache_requests_total', {'result': 'hit'})
+        return path
+
+    def new_file(self):
+        """Return a temporary path in the cache directory to be handed to
+        `store` once it is written
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        os_int, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        os.close(os_int)
+        return tmp_path
+
+    def store(self, key, source_path, move=False):
+        """Add the packet at `source_path` under `key`. The file is moved
+        into the cache when `move` is set and copied otherwise.
+        """
+        if key is None:
+            return
+        digest, templates = key
+        size = os.path.getsize(source_path)
+        if size > self.max_bytes:
+            if move:
+                os.remove(source_path)
+            return
+        if not move:
+            tmp_path = self.new_file()
+            shutil.copyfile(source_path, tmp_path)
+            source_path = tmp_path
+        os.replace(source_path, self._path(digest))
+        with self._lock:
+            if digest in self._entries:
+                self._size -= self._entries[digest][0]
+            self._entries[digest] = (size, templates)
+            self._entries.move_to_end(digest)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._load()
+            for key in list(self._entries):
+                self._remove(key)
+            self._templates.clear()
+
+
+packet_cache = PacketCache(
+    os.environ.get('PACKET_CACHE_DIR', '.packet_cache'),
+    int(os.environ.get('PACKET_CACHE_BYTES', 512 * 1024 * 1024)))
+
+
+def restore_cached_packet(json_obj, progress=None, key=None):
+    """Copy the cached render of `json_obj` to `<outputFileName>.pdf` in
+    parent_directory and return the output file name, or None on a miss
+    """
+    key = key or packet_cache.key(json_obj)
+    if key is None:
+        return None
+    output_file = json_obj['outputFileName']
+    packet_path = os.path.join(parent_directory, output_file+".pdf")
+    index = packet_index.load(packet_path)
+    if index and index.get('cache_key') and index['cache_key'][0] == key[0]:
+        # this payload was rendered here last, keep its parts and index so
+        # per-student downloads and /update go on working
+        metrics.inc('flaskapp_packet_cache_requests_total', {'result': 'hit'})
+    else:
+        cached_path = packet_cache.get(key)
+        if cached_path is None:
+            return None
+        try:
+            shutil.copyfile(cached_path, packet_path)
+        except FileNotFoundError:
+            # evicted while we were copying it
+            return None
+        # whatever parts were kept for this packet belong to another payload
+        packet_index.discard(packet_path)
+    if progress:
+        students = json_obj.get('courseParticipants1', {}).get('student-info', [])
+        for i, each_obj in enumerate(students):
+            progress(i, each_obj.get('cp-name'))
+    return output_file
+
+
+def lookup_packet(json_obj, progress=None, cache_key=None):
+    """Return the (cache key, restored output file name or None) of a
+    payload about to be rendered. With a `cache_key` the caller already
+    missed the cache, so it is not asked again.
+    """
+    if cache_key is not None:
+        return cache_key, None
+    key = packet_cache.key(json_obj)
+    return key, restore_cached_packet(json_obj, progress, key)
+
+
+class PacketIndex:
+    """Keeps rendered packets as per-segment parts: the course forms and
+    each student's checklists, with an index of which pages of the merged
+    packet each of them fills.
+
+    Everything for a packet lives in a directory of `index_dir` named after
+    the packet path: the part files and an index.json listing the segments
+    as {'segment', 'name', 'fingerprint', 'parts', 'pages'}. The merged
+    packet is only built when it is asked for, see assemble_packet. The
+    page ranges and the 'stamp' (size and mtime) of the merged packet are
+    recorded then; anything else writing the packet makes them stale.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+
+    @property
+    def enabled(self):
+        return bool(self.index_dir)
+
+    def _dir(self, packet_path):
+        digest = hashlib.sha1(os.path.abspath(packet_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.index_dir, digest)
+
+    @staticmethod
+    def stamp(packet_path):
+        try:
+            stat = os.stat(packet_path)
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def is_assembled(self, packet_path, index):
+        """True when the merged packet on disk is the one `index` describes"""
+        return index.get('stamp') is not None and index['stamp'] == self.stamp(packet_path)
+
+    def part_path(self, packet_path, part):
+        return os.path.join(self._dir(packet_path), part)
+
+    def write_parts(self, packet_path, fingerprint, documents):
+        """Store the documents of one segment and return their part names"""
+        directory = self._dir(packet_path)
+        os.makedirs(directory, exist_ok=True)
+        prefix = fingerprint or uuid.uuid4().hex
+        parts = []
+        for k, document in enumerate(documents):
+            part = '{}-{}.pdf'.format(prefix, k)
+            with open(os.path.join(directory, part), 'wb') as f:
+                f.write(document)
+            parts.append(part)
+        return parts
+
+    def save(self, packet_path, index):
+        directory = self._dir(packet_path)
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, 'index.json')
+        tmp_path = index_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+        # drop the parts of segments that are gone
+        used = {part for segment in index['segments'] for part in segment.get('parts') or ()}
+        for name in os.listdir(directory):
+            if name.endswith('.pdf') and name not in used:
+                os.remove(os.path.join(directory, name))
+
+    def load(self, packet_path):
+        """Return the index of `packet_path`, or None when there is none"""
+        if not self.index_dir:
+            return None
+        try:
+            with open(os.path.join(self._dir(packet_path), 'index.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def discard(self, packet_path):
+        if self.index_dir:
+            shutil.rmtree(self._dir(packet_path), ignore_errors=True)
+
+
+packet_index = PacketIndex(os.environ.get('PACKET_INDEX_DIR', '.packet_index'))
+
+
+def iter_packet_documents(json_obj, progress=None):
+    """Fill the checklists selected in a /submit payload and yield them as
+    pdf bytes in packet order, the course roster first and then the
+    checklists of each student. `progress(index, student_name)` is called after
+    each student's checklists are done.
+    """
+    with metrics.span('field_mapping'):
+        course_tasks, student_tasks = build_packet_tasks(json_obj)
+    for _, documents in iter_packet_segments(
+            course_tasks, student_tasks, progress, bool(json_obj.get('flatten'))):
+        yield from documents
+
+
+def iter_packet_segments(course_tasks, student_tasks, progress=None, flatten=False):
+    """Fill the tasks of build_packet_tasks and yield (segment, documents)
+    pairs in packet order: ('course', [...]) with the course level forms,
+    then (index, [...]) with the checklists of each student. With
+    `flatten` the documents come back flattened.
+
+    Intermediate files live in a scratch directory private to this call.
+    """
+    if get_render_mode() == 'fill' and get_render_broker() is None and get_render_pool() is None:
+        yield from iter_batched_segments(course_tasks, student_tasks, progress, flatten)
+        return
+
+    with ScratchSpace() as scratch:
+        if get_render_broker() is not None:
+            course_documents = list(render_map(render_checklist, [
+                (pdf_path, answers, scratch.directory, flatten)
+                for pdf_path, answers in course_tasks]))
+        else:
+            course_documents = [render_checklist(pdf_path, answers, scratch.directory, flatten)
+                                for pdf_path, answers in course_tasks]
+        yield 'course', course_documents
+
+        # students are rendered in parallel, results come back in roster order
+        tasks = [(pdf_paths, answers, scratch.directory, flatten)
+                 for _, pdf_paths, answers in student_tasks]
+        for i, student_pdf in enumerate(render_map(render_student, tasks)):
+            yield i, [student_pdf]
+
+            metrics.inc('flaskapp_students_rendered_total')
+            if progress:
+                progress(i, student_tasks[i][0])
+
+
+def iter_batched_segments(course_tasks, student_tasks, progress=None, flatten=False):
+    """iter_packet_segments without a render pool: checklists are filled
+    with one backend call per student instead of one call per checklist,
+    and every student is yielded as soon as their batch is done.
+    PDFPARSER_BATCH_CHECKLISTS puts several students in one call once their
+    checklists add up to no more than that, which saves JVM starts when
+    pdfparser runs without the worker pool.
+    """
+    limit = int(os.environ.get('PDFPARSER_BATCH_CHECKLISTS', 1))
+
+    def batches():
+        batch = []
+        size = 0
+        for i, (_, pdf_paths, answers) in enumerate(student_tasks):
+            if batch and size + len(pdf_paths) > limit:
+                yield batch
+                batch, size = [], 0
+            batch.append((i, [(pdf_path, answers) for pdf_path in pdf_paths]))
+            size += len(pdf_paths)
+        if batch:
+            yield batch
+
+    with ScratchSpace() as scratch:
+        obj = PDFParser(tmp_path=scratch.directory, clean_up=True)
+        yield 'course', obj.fill_batch(course_tasks, flatten=flatten) if course_tasks else []
+
+        for batch in batches():
+            manifest = [task for _, tasks in batch for task in tasks]
+            documents = obj.fill_batch(manifest, flatten=flatten) if manifest else []
+            start = 0
+            for i, tasks in batch:
+                yield i, documents[start:start + len(tasks)]
+                start += len(tasks)
+
+                metrics.inc('flaskapp_students_rendered_total')
+                if progress:
+                    progress(i, student_tasks[i][0])
+
+
+def render_packet(json_obj, progress=None, cache_key=None):
+    """Render a /submit payload for `<outputFileName>.pdf` in
+    parent_directory and return the output file name.
+
+    In fill mode only the parts of the packet are rendered, the merged
+    packet is built by assemble_packet the first time it is downloaded.
+    A `cache_key` is the packet_cache.key of a payload the caller already
+    looked up in the cache and missed.
+    """
+    key, output_file = lookup_packet(json_obj, progress, cache_key)
+    if output_file is not None:
+        return output_file
+
+    output_file = json_obj['outputFileName']
+    packet_path = os.path.join(parent_directory, output_file+".pdf")
+    if get_render_mode() == 'overlay':
+        render_overlay_packet(json_obj, progress)
+        packet_cache.store(key, packet_path)
+        return output_file
+
+    flatten = bool(json_obj.get('flatten'))
+    with metrics.span('field_mapping'):
+        course_tasks, student_tasks = build_packet_tasks(json_obj)
+
+    if not packet_index.enabled:
+        with open(packet_path, 'wb') as f:
+            write_merged(f, (documents for _, documents in iter_packet_segments(
+                course_tasks, student_tasks, progress, flatten)))
+        packet_cache.store(key, packet_path)
+        return output_file
+
+    fingerprints = segment_fingerprints(course_tasks, student_tasks, flatten)
+    segments = []
+    for segment, documents in iter_packet_segments(
+            course_tasks, student_tasks, progress, flatten):
+        parts = packet_index.write_parts(packet_path, fingerprints[segment], documents)
+        segments.append(packet_segment(segment, student_tasks, fingerprints, parts))
+    packet_index.save(packet_path, {'segments': segments, 'cache_key': key, 'stamp': None})
+    # an earlier merged packet of the same name is out of date now
+    if os.path.exists(packet_path):
+        os.remove(packet_path)
+    return output_file
+
+
+# packet_path -> [lock, number of threads using it], so merges of
+# different packets never wait for each other
+_assemble_locks = {}
+_assemble_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _assemble_lock(packet_path):
+    with _assemble_locks_lock:
+        entry = _assemble_locks.setdefault(packet_path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _assemble_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _assemble_locks[packet_path]
+
+
+def assemble_packet(output_file):
+    """Return the path of `<output_file>.pdf` in parent_directory, merging
+    the packet from its parts first when that has not happened yet
+    """
+    packet_path = os.path.join(parent_directory, output_file+".pdf")
+    index = packet_index.load(packet_path)
+    if index is None or packet_index.is_assembled(packet_path, index):
+        return packet_path
+    with _assemble_lock(packet_path):
+        # another thread may have merged it while this one waited
+        index = packet_index.load(packet_path)
+        if index is None or packet_index.is_assembled(packet_path, index):
+            return packet_path
+        tmp_path = packet_path + '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            pages = write_merged(f, ([packet_index.part_path(packet_path, part)
+                                      for part in segment['parts']]
+                                     for segment in index['segments']))
+        for segment, segment_pages in zip(index['segments'], pages):
+            segment['pages'] = segment_pages
+        os.replace(tmp_path, packet_path)
+        index['stamp'] = packet_index.stamp(packet_path)
+        packet_index.save(packet_path, index)
+    if index.get('cache_key'):
+        packet_cache.store(index['cache_key'], packet_path)
+    return packet_path
+
+
+def extract_students(output_file, first, last):
+    """Return students `first` to `last` (inclusive, counting from 0) of
+    a rendered packet as pdf bytes, or None when the packet has no such
+    students. Uses the students' parts when they were kept and their pages
+    in the merged packet otherwise.
+    """
+    packet_path = os.path.join(parent_directory, output_file+".pdf")
+    index = packet_index.load(packet_path)
+    if index is None:
+        return None
+    students = [segment for segment in index['segments'] if segment['segment'] != 'course']
+    if first < 0 or last >= len(students):
+        return None
+    students = students[first:last + 1]
+    output = io.BytesIO()
+    if all(segment['parts'] is not None for segment in students):
+        write_merged(output, [[packet_index.part_path(packet_path, part)
+                               for part in segment['parts']] for segment in students])
+    elif packet_index.is_assembled(packet_path, index):
+        with open(packet_path, 'rb') as f:
+            reader = PdfFileReader(io.BytesIO(f.read()), strict=False)
+        writer = PdfFileWriter()
+        for segment in students:
+            for page in range(*segment['pages']):
+                writer.addPage(reader.getPage(page))
+        writer.write(output)
+    else:
+        return None
+    return output.getvalue()
+
+
+def segment_fingerprints(course_tasks, student_tasks, flatten=False):
+    """Return {segment: digest} of everything that goes into rendering each
+    segment, or None for a segment whose templates cannot be read
+    """
+    fingerprints = {'course': tasks_fingerprint(course_tasks, flatten)}
+    for i, (_, pdf_paths, answers) in enumerate(student_tasks):
+        fingerprints[i] = tasks_fingerprint(
+            [(pdf_path, answers) for pdf_path in pdf_paths], flatten)
+    return fingerprints
+
+
+def tasks_fingerprint(tasks, flatten=False):
+    """Digest of the (pdf_path, answers) tasks of one segment, None when a
+    template cannot be read
+    """
+    sha = hashlib.sha1()
+    sha.update('{}:{}:{}'.format(
+        get_render_mode(), os.environ.get('PDFPARSER_BACKEND', 'jar'),
+        'flat' if flatten else 'form').encode('utf-8'))
+    for pdf_path, answers in tasks:
+        try:
+            digest = field_schema_cache.key(pdf_path)[2]
+        except OSError:
+            return None
+        sha.update(json.dumps([pdf_path, digest, answers], sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def packet_segment(segment, student_tasks, fingerprints, parts=None, pages=None):
+    return {
+        'segment': segment,
+        'name': student_tasks[segment][0] if segment != 'course' else None,
+        'fingerprint': fingerprints.get(segment),
+        'parts': parts,
+        'pages': pages,
+    }
+
+
+def update_packet(json_obj, progress=None, cache_key=None):
+    """Bring a packet made by render_packet in line with an edited payload.
+    Only the course forms and the students whose answers changed are filled
+    again, the parts of everyone else are kept. When the merged packet was
+    already built, the new pages are spliced into it.
+    Falls back to render_packet when there is no index to work from.
+    """
+    output_file = json_obj['outputFileName']
+    packet_path = os.path.join(parent_directory, output_file+".pdf")
+    index = packet_index.load(packet_path) if get_render_mode() == 'fill' else None
+    if not index or any(segment['parts'] is None for segment in index['segments']):
+        return render_packet(json_obj, progress, cache_key)
+
+    key, cached_file = lookup_packet(json_obj, progress, cache_key)
+    if cached_file is not None:
+        return output_file
+
+    flatten = bool(json_obj.get('flatten'))
+    with metrics.span('field_mapping'):
+        course_tasks, student_tasks = build_packet_tasks(json_obj)
+    fingerprints = segment_fingerprints(course_tasks, student_tasks, flatten)
+    reusable = {segment['fingerprint']: segment
+                for segment in index['segments'] if segment['fingerprint']}
+
+    stale = [i for i in range(len(student_tasks)) if fingerprints[i] not in reusable]
+    for i, (student_name, _, _) in enumerate(student_tasks):
+        if progress and fingerprints[i] in reusable:
+            progress(i, student_name)
+
+    def stale_progress(i, student_name):
+        if progress:
+            progress(stale[i], student_name)
+
+    rendered = {}
+    course_stale = fingerprints['course'] not in reusable
+    for segment, documents in iter_packet_segments(
+            course_tasks if course_stale else [],
+            [student_tasks[i] for i in stale], stale_progress, flatten):
+        if segment == 'course':
+            if course_stale:
+                rendered['course'] = documents
+        else:
+            rendered[stale[segment]] = documents
+    logger.info("updating %s: %d of %d students changed",
+                output_file, len(stale), len(student_tasks))
+
+    writer = None
+    if packet_index.is_assembled(packet_path, index):
+        with open(packet_path, 'rb') as f:
+            existing = f.read()
+        writer = PdfUpdateWriter(existing, dedupe=get_merge_mode() == 'dedupe')
+    chunks = []
+    segments = []
+    for segment in ['course'] + list(range(len(student_tasks))):
+        pages = None
+        if segment in rendered:
+            parts = packet_index.write_parts(packet_path, fingerprints[segment], rendered[segment])
+            if writer is not None:
+                start = writer.page_count
+                for document in rendered[segment]:
+                    with metrics.span('merge'):
+                        chunks.append(writer.add_document(document))
+                pages = [start, writer.page_count]
+        else:
+            reused = reusable[fingerprints[segment]]
+            parts = reused['parts']
+            if writer is not None:
+                start = writer.page_count
+                writer.add_existing(*reused['pages'])
+                pages = [start, writer.page_count]
+        segments.append(packet_segment(segment, student_tasks, fingerprints, parts, pages))
+
+    index = {'segments': segments, 'cache_key': key, 'stamp': None}
+    if writer is None:
+        packet_index.save(packet_path, index)
+        if os.path.exists(packet_path):
+            os.remove(packet_path)
+        return output_file
+
+    # the update is appended to a copy so readers never see half of it
+    tmp_path = packet_path + '.{}.tmp'.format(os.getpid())
+    with metrics.span('write'), open(tmp_path, 'wb') as f:
+        f.write(existing)
+        f.writelines(chunks)
+        f.write(writer.finish())
+    os.replace(tmp_path, packet_path)
+    index['stamp'] = packet_index.stamp(packet_path)
+    packet_index.save(packet_path, index)
+    packet_cache.store(key, packet_path)
+    return output_file
+
+
+def render_overlay_packet(json_obj, progress=None):
+    """render_packet for the overlay mode. Every student's pages go into one
+    writer, so each template's content is written to the packet only once
+    and a student only adds the drawing of their own values.
+    """
+    flatten = bool(json_obj.get('flatten'))
+    with metrics.span('field_mapping'):
+        course_tasks, student_tasks = build_packet_tasks(json_obj)
+    writer = PdfFileWriter()
+    segments = []
+    with ScratchSpace() as scratch:
+        for pdf_path, answers in course_tasks:
+            obj = PDFParser(tmp_path=scratch.directory, clean_up=True)
+            filled = PdfFileReader(
+                io.BytesIO(obj.fill_pdf(pdf_path, answers, flatten)), strict=False)
+            for page in filled.pages:
+                writer.addPage(page)
+        segments.append(packet_segment('course', student_tasks, {}, pages=[0, writer.getNumPages()]))
+        for i, (student_name, pdf_paths, answers) in enumerate(student_tasks):
+            start = writer.getNumPages()
+            for pdf_path in pdf_paths:
+                get_overlay_template(pdf_path).add_pages(writer, answers, flatten)
+            segments.append(packet_segment(i, student_tasks, {}, pages=[start, writer.getNumPages()]))
+            metrics.inc('flaskapp_students_rendered_total')
+            if progress:
+                progress(i, student_name)
+
+        output_file = json_obj['outputFileName']
+        packet_path = os.path.join(parent_directory, output_file+".pdf")
+        with metrics.span('write'), open(packet_path, 'wb') as f:
+            writer.write(f)
+    if packet_index.enabled:
+        # no parts, students are cut out of the merged packet
+        packet_index.save(packet_path, {'segments': segments, 'cache_key': None,
+                                        'stamp': packet_index.stamp(packet_path)})
+    return output_file
+
+
+def open_cached_packet(key):
+    """Open the cached packet for `key` for reading, None on a miss. The
+    open file survives the entry being evicted while it is sent.
+    """
+    cached_path = packet_cache.get(key)
+    if cached_path is None:
+        return None
+    try:
+        return open(cached_path, 'rb')
+    except FileNotFoundError:
+        return None
+
+
+def stream_packet(json_obj, key, cached=None):
+    """Render a /submit payload and yield the merged pdf in pieces, each
+    student's pages going out as soon as they are rendered. `key` is its
+    packet_cache.key and `cached` the open_cached_packet file of a hit,
+    which is sent instead.
+
+    Streamed packets are only written to the cache with
+    PACKET_CACHE_STREAMS=1: streaming exists to keep a full copy of the
+    packet off the disk.
+    """
+    if cached is not None:
+        with cached:
+            for chunk in iter(lambda: cached.read(1 << 16), b''):
+                yield chunk
+        return
+
+    writer = StreamingPdfWriter(dedupe=get_merge_mode() == 'dedupe')
+    if key is None or os.environ.get('PACKET_CACHE_STREAMS', '0') != '1':
+        yield from iter_stream_chunks(writer, json_obj)
+        return
+
+    tmp_path = packet_cache.new_file()
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter_stream_chunks(writer, json_obj):
+                f.write(chunk)
+                yield chunk
+    except BaseException:
+        # failed or the client went away, keep the partial file out of the cache
+        os.remove(tmp_path)
+        raise
+    packet_cache.store(key, tmp_path, move=True)
+
+
+def iter_stream_chunks(writer, json_obj):
+    yield writer.header()
+    for document in iter_packet_documents(json_obj):
+        with metrics.span('merge'):
+            chunk = writer.add_document(document)
+        yield chunk
+    with metrics.span('write'):
+        chunk = writer.finish()
+    yield chunk
+
+
+# roster file column (lower case) -> the 'courseParticipants1' key prefix
+# or 'student-info' key it fills. Columns can be named after the form key
+# ('cp-email'), without its prefix ('email') or after the pdf field ('Email').
+ROSTER_COLUMNS = {}
+for _prefix, _field in COMMON_FIELD_MAPPING['indexed'].items():
+    if _prefix.startswith('cp-'):
+        for _column in (_prefix, _prefix[3:], _field):
+            ROSTER_COLUMNS[_column.lower()] = _prefix
+ROSTER_COLUMNS.update({
+    'cp-dot': 'cp-dot', 'dot': 'cp-dot', 'date of test': 'cp-dot',
+    'selected-checkboxes': 'selected-checkboxes', 'checklists': 'selected-checkboxes',
+})
+
+
+class RosterError(ValueError):
+    """An uploaded roster that cannot be read"""
+
+
+def iter_roster_rows(path, kind):
+    """Yield the rows of a 'csv' or 'xlsx' roster file one at a time as
+    {column: value} dicts keyed by the ROSTER_COLUMNS they map to
+    """
+    if kind == 'csv':
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            yield from _roster_rows(csv.reader(f))
+    elif kind == 'xlsx':
+        if openpyxl is None:
+            raise RosterError("xlsx rosters need openpyxl, upload a csv file instead")
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            yield from _roster_rows(workbook.active.iter_rows(values_only=True))
+        finally:
+            workbook.close()
+    else:
+        raise RosterError("unsupported roster format {!r}".format(kind))
+
+
+def _roster_rows(rows):
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        raise RosterError("the roster is empty")
+    columns = [ROSTER_COLUMNS.get(str(cell or '').strip().lower()) for cell in header]
+    if 'cp-name' not in columns:
+        raise RosterError("the roster has no name column")
+    for row in rows:
+        values = {}
+        for column, cell in zip(columns, row):
+            if column is None or cell is None:
+                continue
+            if isinstance(cell, (datetime.date, datetime.datetime)):
+                cell = cell.strftime('%m/%d/%Y')
+            values[column] = str(cell).strip()
+        if values.get('cp-name'):
+            yield values
+
+
+def iter_roster_students(rows, catalog):
+    """Turn roster rows into (participant_fields, student_info) pairs: the
+    'cp-<field>-<k>' keys of 'courseParticipants1' for the course roster
+    and the 'student-info' entry of the k-th student
+    """
+    for k, values in enumerate(rows):
+        checklists = [name.strip() for name in values.get('selected-checkboxes', '').split(';')
+                      if name.strip()]
+        for name in checklists:
+            if catalog.get(name) is None:
+                raise RosterError("row {}: unknown checklist {!r}".format(k + 2, name))
+        participant_fields = {
+            '{}-{}'.format(column, k): value for column, value in values.items()
+            if column.startswith('cp-') and column != 'cp-dot'}
+        yield participant_fields, {
+            'cp-name': values['cp-name'],
+            'cp-dot': values.get('cp-dot', ''),
+            'selected-checkboxes': checklists,
+        }
+
+
+def roster_checklists(path, kind):
+    """The names of the checklists a roster file selects, sorted"""
+    names = set()
+    for values in iter_roster_rows(path, kind):
+        names.update(name.strip() for name in values.get('selected-checkboxes', '').split(';')
+                     if name.strip())
+    return sorted(names)
+
+
+def render_roster_packet(json_obj, roster_path, kind, progress=None, cache_key=None):
+    """render_packet for an uploaded roster. The students are read from
+    the roster file one row at a time and each is handed to the render
+    processes as soon as it is read; only the course roster form, which
+    lists everyone, waits for the last row.
+    """
+    key, output_file = lookup_packet(json_obj, progress, cache_key)
+    if output_file is not None:
+        return output_file
+
+    output_file = json_obj['outputFileName']
+    packet_path = os.path.join(parent_directory, output_file+".pdf")
+    flatten = bool(json_obj.get('flatten'))
+    tasks = PacketTasks(json_obj)
+    participants = {k: v for k, v in json_obj.get('courseParticipants1', {}).items()
+                    if k != 'student-info'}
+    # name and fingerprint of every student that is rendering
+    rendering = collections.deque()
+
+    with ScratchSpace() as scratch:
+        def student_tasks():
+            rows = iter_roster_rows(roster_path, kind)
+            for participant_fields, each_obj in iter_roster_students(rows, tasks.catalog):
+                participants.update(participant_fields)
+                student_name, pdf_paths, answers = tasks.student_task(each_obj)
+                rendering.append((student_name, tasks_fingerprint(
+                    [(pdf_path, answers) for pdf_path in pdf_paths], flatten)))
+                yield pdf_paths, answers, scratch.directory, flatten
+
+        segments = []
+        for i, student_pdf in enumerate(render_map(render_student, student_tasks())):
+            student_name, fingerprint = rendering.popleft()
+            if packet_index.enabled:
+                parts = packet_index.write_parts(packet_path, fingerprint, [student_pdf])
+            else:
+                parts = [os.path.join(scratch.directory, 'student-{}.pdf'.format(i))]
+                with open(parts[0], 'wb') as f:
+                    f.write(student_pdf)
+            segments.append({'segment': i, 'name': student_name, 'fingerprint': fingerprint,
+                             'parts': parts, 'pages': None})
+            metrics.inc('flaskapp_students_rendered_total')
+            if progress:
+                progress(i, student_name)
+
+        course_json = dict(json_obj, courseParticipants1=participants)
+        course_tasks = tasks.course_tasks(course_json)
+        if get_render_broker() is not None:
+            course_documents = list(render_map(render_checklist, [
+                (pdf_path, answers, scratch.directory, flatten)
+                for pdf_path, answers in course_tasks]))
+        else:
+            obj = PDFParser(tmp_path=scratch.directory, clean_up=True)
+            course_documents = obj.fill_batch(course_tasks, flatten=flatten) if course_tasks else []
+
+        if not packet_index.enabled:
+            with open(packet_path, 'wb') as f:
+                write_merged(f, [course_documents] + [segment['parts'] for segment in segments])
+            packet_cache.store(key, packet_path)
+            return output_file
+
+    fingerprint = tasks_fingerprint(course_tasks, flatten)
+    segments.insert(0, {'segment': 'course', 'name': None, 'fingerprint': fingerprint,
+                        'parts': packet_index.write_parts(packet_path, fingerprint, course_documents),
+                        'pages': None})
+    packet_index.save(packet_path, {'segments': segments, 'cache_key': key, 'stamp': None})
+    if os.path.exists(packet_path):
+        os.remove(packet_path)
+    return output_file
+
+
+class RenderJob:
+
+    def __init__(self, payload, render=None):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.render = render or render_packet
+        self.status = 'queued'
+        self.filepath = None
+        self.error = None
+        self.finished_at = None
+        self.queued_at = time.perf_counter()
+        self.queue_seconds = None
+        # packet_cache.key of the payload, looked up once when submitted
+        self.cache_key = None
+        # set by the JobQueue to share the status with other processes
+        self.publish = None
+        self._published_at = 0
+        students = payload.get('courseParticipants1', {}).get('student-info', [])
+        self.students = [
+            {'name': each_obj.get('cp-name'), 'status': 'queued'}
+            for each_obj in students
+        ]
+
+    def update(self, index, student_name):
+        # imported rosters are only known as they are read
+        while len(self.students) <= index:
+            self.students.append({'name': None, 'status': 'queued'})
+        self.students[index]['name'] = student_name
+        self.students[index]['status'] = 'done'
+        now = time.monotonic()
+        if self.publish is not None and now - self._published_at > 0.5:
+            self._published_at = now
+            self.publish(self)
+
+    def to_dict(self):
+        done = sum(1 for student in self.students if student['status'] == 'done')
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'progress': {'done': done, 'total': len(self.students)},
+            'students': self.students,
+            'filepath': self.filepath,
+            'error': self.error,
+            'queue_seconds': self.queue_seconds,
+        }
+
+
+class QueueFull(Exception):
+    """Raised when the render queue already holds as many waiting renders
+    as it may. `retry_after` is a guess in seconds of when to try again.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("render queue is full, retry in {}s".format(retry_after))
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """Runs /submit payloads on background threads and keeps their status
+    around for `ttl` seconds after they finish. With a `status_dir` the
+    status is also written there, so any web worker process can answer
+    /jobs/<job_id> for a job another one is running.
+
+    At most `workers` renders run at once, queued jobs and streamed
+    renders (see slot()) share those slots. When `depth` renders are
+    already waiting for one, new ones are refused with QueueFull.
+    """
+
+    def __init__(self, workers=2, ttl=3600, status_dir=None, depth=0):
+        self.workers = workers
+        self.ttl = ttl
+        self.status_dir = status_dir or None
+        self.depth = depth
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(workers)
+        self._waiting = 0
+        # moving average of how long a render holds its slot
+        self._render_seconds = 5.0
+
+    def _admit(self):
+        with self._lock:
+            if self.depth and self._waiting >= self.depth:
+                metrics.inc('flaskapp_render_rejected_total')
+                raise QueueFull(self.retry_after())
+            self._waiting += 1
+
+    def _finished(self, seconds):
+        with self._lock:
+            self._render_seconds = 0.8 * self._render_seconds + 0.2 * seconds
+
+    def retry_after(self):
+        """Seconds until the renders waiting now have likely started"""
+        return max(1, int(math.ceil(self._render_seconds * (self._waiting + 1) / self.workers)))
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Wait for a render slot the way a queued job does, for renders
+        that run on the calling thread. Raises QueueFull right away when
+        too many renders are waiting already.
+        """
+        self._admit()
+        queued_at = time.perf_counter()
+        try:
+            self._slots.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        started_at = time.perf_counter()
+        metrics.observe('flaskapp_queue_wait_seconds', started_at - queued_at, {'kind': 'stream'})
+        try:
+            yield
+        finally:
+            self._slots.release()
+            self._finished(time.perf_counter() - started_at)
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _prune(self):
+        now = time.time()
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job.finished_at and now - job.finished_at > self.ttl:
+                    del self._jobs[job_id]
+        if self.status_dir is None or not os.path.isdir(self.status_dir):
+            return
+        for entry in os.scandir(self.status_dir):
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _status_path(self, job_id):
+        return os.path.join(self.status_dir, job_id + '.json')
+
+    def _publish(self, job):
+        if self.status_dir is None:
+            return
+        path = self._status_path(job.id)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.status_dir, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(job.to_dict(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("could not publish the status of job %s", job.id)
+
+    def submit(self, payload, render=None):
+        """Queue `render(payload, progress, cache_key)`, render_packet by
+        default
+        """
+        self._start()
+        self._prune()
+        job = RenderJob(payload, render)
+        job.publish = self._publish
+        # a packet that was rendered before does not have to wait in line
+        job.cache_key = packet_cache.key(payload)
+        job.filepath = restore_cached_packet(payload, job.update, job.cache_key)
+        if job.filepath is None:
+            # raises QueueFull before the job is known to anyone
+            self._admit()
+        with self._lock:
+            self._jobs[job.id] = job
+        if job.filepath is not None:
+            job.status = 'success'
+            metrics.inc('flaskapp_render_jobs_total', {'status': 'cached'})
+            job.finished_at = time.time()
+            job.payload = None
+            job.cache_key = None
+            self._publish(job)
+            return job
+        self._publish(job)
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def status(self, job_id):
+        """Return the status dict of a job run by this or, when they share
+        the status_dir, any other process, or None for an unknown job
+        """
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.status_dir is None or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            with open(self._status_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            self._slots.acquire()
+            with self._lock:
+                self._waiting -= 1
+            started_at = time.perf_counter()
+            job.queue_seconds = started_at - job.queued_at
+            metrics.observe('flaskapp_queue_wait_seconds', job.queue_seconds, {'kind': 'job'})
+            job.status = 'running'
+            self._publish(job)
+            try:
+                job.filepath = job.render(job.payload, progress=job.update,
+                                          cache_key=job.cache_key)
+                job.status = 'success'
+            except Exception as e:
+                logger.exception("job %s failed", job.id)
+                job.error = str(e)
+                job.status = 'failed'
+            finally:
+                self._slots.release()
+                self._finished(time.perf_counter() - started_at)
+            job.finished_at = time.time()
+            job.payload = None
+            job.cache_key = None
+            self._publish(job)
+            metrics.inc('flaskapp_render_jobs_total', {'status': job.status})
+
+
+render_jobs = JobQueue(
+    int(os.environ.get('RENDER_JOB_WORKERS', 2)),
+    status_dir=os.environ.get('JOB_STATUS_DIR', '.job_status'),
+    depth=int(os.environ.get('RENDER_QUEUE_DEPTH', 16)))
+
+
+@bp.errorhandler(QueueFull)
+def queue_full(e):
+    response = jsonify({"status": "busy", "error": str(e), "retry_after": e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@bp.route('/submit', methods=['POST'])
+def submit_form():
+    if not request.json or len(request.json) < 0:
+        abort(400)
+    json_obj = request.get_json()
+    if request.args.get('flatten') == '1':
+        json_obj['flatten'] = True
+    if log_sampled(logging.DEBUG):
+        logger.debug("submit payload: %s", json.dumps(json_obj))
+    if request.args.get('stream') == '1' or json_obj.get('stream'):
+        output_file = json_obj['outputFileName']
+        slot = contextlib.ExitStack()
+        key = packet_cache.key(json_obj)
+        cached = open_cached_packet(key)
+        if cached is None:
+            # wait here for a render slot, released once the response is closed
+            slot.enter_context(render_jobs.slot())
+        else:
+            slot.callback(cached.close)
+        response = Response(
+            stream_packet(json_obj, key, cached),
+            mimetype='application/pdf',
+            headers={'Content-Disposition': 'attachment; filename="{}.pdf"'.format(output_file)})
+        response.call_on_close(slot.close)
+        return response
+    job = render_jobs.submit(json_obj)
+    return jsonify({"status": "queued", "job_id": job.id,
+                    "status_url": url_for('.job_status', job_id=job.id)}), 202
+
+
+@bp.route('/update', methods=['POST'])
+def update_form():
+    """Like /submit for a packet that was already rendered, only the
+    students whose answers changed are rendered again
+    """
+    if not request.json:
+        abort(400)
+    json_obj = request.get_json()
+    if request.args.get('flatten') == '1':
+        json_obj['flatten'] = True
+    job = render_jobs.submit(json_obj, update_packet)
+    return jsonify({"status": "queued", "job_id": job.id,
+                    "status_url": url_for('.job_status', job_id=job.id)}), 202
+
+
+ROSTER_FORMATS = {'.csv': 'csv', '.xlsx': 'xlsx'}
+
+
+class UploadRequest(Request):
+    """Spools uploaded files to named files in the scratch root, so a view
+    can keep an upload by linking it instead of copying it again. The
+    spooled file itself goes away with the request.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return tempfile.NamedTemporaryFile(
+            'wb+', prefix='flaskapp-upload-', dir=get_scratch_root())
+
+
+def keep_upload(upload, path):
+    """Give the uploaded file `upload` the name `path`, by a hard link to
+    the file UploadRequest spooled it to when possible
+    """
+    upload.stream.flush()
+    name = getattr(upload.stream, 'name', None)
+    if isinstance(name, str):
+        try:
+            os.link(name, path)
+            return
+        except OSError:
+            pass
+    upload.save(path)
+
+
+@bp.route('/import', methods=['POST'])
+def import_roster():
+    """Like /submit for a roster uploaded as a csv or xlsx file. The
+    multipart form carries the file as 'roster' and the rest of the /submit
+    payload, without the students, as the 'payload' JSON field. The job
+    reads the file Werkzeug spooled the upload to one row at a time.
+    """
+    roster = request.files.get('roster')
+    try:
+        json_obj = json.loads(request.form.get('payload', ''))
+    except ValueError:
+        abort(400)
+    if roster is None or not isinstance(json_obj, dict) or 'outputFileName' not in json_obj:
+        abort(400)
+    kind = ROSTER_FORMATS.get(os.path.splitext(roster.filename or '')[1].lower())
+    if kind is None or (kind == 'xlsx' and openpyxl is None):
+        abort(415)
+    if request.args.get('flatten') == '1':
+        json_obj['flatten'] = True
+
+    # the students are not in the payload, key the packet cache on the file
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: roster.stream.read(1 << 16), b''):
+        digest.update(chunk)
+    roster.stream.seek(0)
+    roster_path = os.path.join(
+        get_scratch_root(), 'flaskapp-roster-{}.{}'.format(uuid.uuid4().hex, kind))
+    keep_upload(roster, roster_path)
+    try:
+        json_obj['rosterDigest'] = digest.hexdigest()
+        # so the packet cache also misses once one of those templates changes
+        try:
+            json_obj['rosterChecklists'] = roster_checklists(roster_path, kind)
+        except RosterError:
+            abort(400)
+        json_obj.setdefault('courseParticipants1', {})['student-info'] = []
+
+        def render(payload, progress=None, cache_key=None):
+            try:
+                return render_roster_packet(payload, roster_path, kind, progress, cache_key)
+            finally:
+                os.remove(roster_path)
+
+        job = render_jobs.submit(json_obj, render)
+    except BaseException:
+        os.remove(roster_path)
+        raise
+    if job.filepath is not None:
+        # restored from the packet cache, the job will never read the file
+        os.remove(roster_path)
+    return jsonify({"status": "queued", "job_id": job.id,
+                    "status_url": url_for('.job_status', job_id=job.id)}), 202
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    status = render_jobs.status(job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+def warm_process(directory=None):
+    """Start this process' pdfparser workers, then load the template
+    catalog of `directory` (parent_directory by default) and the field
+    schema (and overlay template) of every template. Render processes
+    are handed the directory, their own parent_directory does not follow
+    create_app's config.
+    """
+    with _warm_process_lock:
+        parser = PDFParser()
+        if parser.backend.name == 'jar':
+            pool = get_worker_pool()
+            if pool is not None:
+                pool.spawn_all()
+        if directory is None or directory == parent_directory:
+            catalog = get_template_catalog()
+        else:
+            catalog = TemplateCatalog(directory)
+        for name in catalog.names():
+            pdf_path = catalog.get(name)
+            try:
+                parser.get_template(pdf_path)
+                if get_render_mode() == 'overlay':
+                    get_overlay_template(pdf_path)
+            except Exception:
+                logger.exception("warm up: could not load %s", pdf_path)
+        return os.getpid()
+
+
+_warm_process_lock = threading.Lock()
+_warm_up = {'status': 'ready', 'error': None, 'seconds': None}
+_warm_up_lock = threading.Lock()
+
+
+def warm_up():
+    """Warm this process and every render process, /ready reports ready
+    once it returns
+    """
+    start = time.perf_counter()
+    try:
+        with metrics.span('warm_up'):
+            warm_process()
+            pool = get_render_pool()
+            if pool is not None:
+                # one task per process; starting a jvm keeps each task busy
+                # long enough that the pool brings up all of its processes
+                futures = [pool.submit(warm_process, parent_directory)
+                           for _ in range(get_render_processes())]
+                pids = {future.result() for future in futures}
+                logger.info("warm up: %d of %d render processes warmed",
+                            len(pids), get_render_processes())
+    except Exception as e:
+        logger.exception("warm up failed")
+        _warm_up.update(status='failed', error=str(e))
+        return
+    _warm_up.update(status='ready', seconds=time.perf_counter() - start)
+    logger.info("warm up finished in %.1fs", _warm_up['seconds'])
+
+
+def start_warm_up():
+    """Run warm_up() on a background thread, once per process"""
+    with _warm_up_lock:
+        if _warm_up['status'] == 'warming':
+            return
+        _warm_up.update(status='warming', error=None, seconds=None)
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+
+@bp.route('/ready', methods=['GET'])
+def readiness():
+    """200 once the process is warm, 503 while it is warming up or when
+    the warm up failed, so load balancers keep traffic away until then
+    """
+    state = dict(_warm_up)
+    if state['status'] == 'ready':
+        return jsonify(state)
+    response = jsonify(state)
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+def create_app(config=None):
+    """Build the Flask app. `config` is applied over the defaults, which
+    come from the environment:
+
+        PARENT_DIRECTORY  template folders and rendered packets ('./')
+        USE_X_SENDFILE    let the front end server send packet files ('0')
+        WARM_UP           warm up in the background before /ready says so ('0')
+
+    Without WARM_UP the template catalog, field schemas, pdfparser workers
+    and render processes are created on first use. Either way every web
+    worker process that imports the app gets its own.
+    """
+    global parent_directory, template_catalog
+    app = Flask(__name__)
+    app.request_class = UploadRequest
+    app.config['PARENT_DIRECTORY'] = parent_directory
+    # hand file bodies to the front end server (apache mod_xsendfile, nginx
+    # X-Accel) instead of streaming them through python
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
+    app.config['WARM_UP'] = os.environ.get('WARM_UP', '0') == '1'
+    app.config.update(config or {})
+    if app.config['PARENT_DIRECTORY'] != parent_directory:
+        # the templates of the old directory must not be used for the new one
+        template_catalog = None
+        _overlay_templates.clear()
+    parent_directory = app.config['PARENT_DIRECTORY']
+    app.register_blueprint(bp)
+    if app.config['WARM_UP']:
+        start_warm_up()
+    return app
+
+
+# the render processes import this module too, they are warmed by the
+# process that owns them and must not start a warm up of their own
+app = create_app({'WARM_UP': False})
 
 
 if __name__ == '__main__':
-    parent_directory = "./"
     os.environ.setdefault("PDFPARSER_PATH", "pdfparser.jar")
+    app = create_app()
+    get_template_catalog()
 
     app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
 
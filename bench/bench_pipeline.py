@@ -0,0 +1,245 @@
+"""Benchmarks for the /submit fill and merge pipeline.
+
+Builds synthetic rosters in the JSON shape index_newmilestone4.html posts,
+with students spread over the bundled ACLS, BLS and PALS checklists, and
+reports per stage latency, throughput and peak RSS for each roster size:
+
+    python bench/bench_pipeline.py                  # 1, 10, 100 and 500 students
+    python bench/bench_pipeline.py --sizes 1 10 --stages submit merge
+
+By default the jar backend talks to bench/fake_pdfparser.py, so no Java is
+needed. --java uses PdfParserWorker.class and pdfparser.jar instead, and
+--backend pypdf2 skips the worker altogether. Every size runs in its own
+process so the peak RSS figures do not leak into each other. The packet MB
+column is the size of the merge / merge_dedupe output.
+"""
+import os
+import sys
+import io
+import copy
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import subprocess
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STAGES = ('submit', 'tasks', 'fill_pdf', 'fill_batch', 'join_pdfs', 'merge', 'merge_dedupe')
+
+COURSE_INFO_FIELDS = [
+    'Lead Instructor', 'Lead Instructor ID#', 'Card Expiration Date',
+    'Training Center', 'Training Center ID#', 'Training Site Name', 'Address',
+    'City, State ZIP', 'Course Location', 'Course Start', 'Course End',
+    'Total Hours', 'No of Cards', 'Student-Manikin Ratio', 'Issue Date',
+    'Instructor Initials', 'Instructor Number',
+]
+
+STUDENT_FIELDS = ['name', 'email', 'mailing', 'phone', 'psa', 'comp-imcomp', 'remed']
+
+
+def build_payload(catalog, students, checklists_per_student=3, seed=0):
+    """Return a /submit payload for a roster of `students` students, each
+    tested on `checklists_per_student` checklists picked from every course
+    """
+    rng = random.Random(seed)
+    names = [name for name in catalog.names() if name != ROSTER_TEMPLATE]
+    course_info = {field: '{} value'.format(field) for field in COURSE_INFO_FIELDS}
+    course_info['Instructor Initials'] = 'JD'
+    course_info['Instructor Number'] = '0042'
+    course_participants1 = {}
+    student_info = []
+    for k in range(students):
+        for field in STUDENT_FIELDS:
+            course_participants1['cp-{}-{}'.format(field, k)] = '{} {}'.format(field, k)
+        student_info.append({
+            'cp-name': 'Student {}'.format(k),
+            'cp-dot': '01/02/2021',
+            'selected-checkboxes': rng.sample(names, min(checklists_per_student, len(names))),
+        })
+    course_participants1['student-info'] = student_info
+    return {
+        'outputFileName': 'bench',
+        'selectedOptions': [ROSTER_TEMPLATE] + rng.sample(names, 1),
+        'courseInfo': course_info,
+        'assistingInstructors': {
+            'assis-name-0': 'Assistant One', 'assis-card-exp-0': '12/2022',
+            'assis-name-1': 'Assistant Two', 'assis-card-exp-1': '06/2023',
+        },
+        'courseParticipants': {
+            'Course': 'BLS',
+            'Lead Instructor Signature': 'J. Doe',
+            'Date': '01/02/2021',
+        },
+        'courseParticipants1': course_participants1,
+    }
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own, children
+
+
+def run_size(students, stages):
+    """Run every stage for one roster size and return the results as a dict"""
+    client = app.app.test_client()
+    payload = build_payload(app.get_template_catalog(), students)
+    result = {'students': students, 'stages': {}}
+
+    # fill the field schema cache so no stage pays for it
+    for name in app.get_template_catalog().names():
+        app.PDFParser().get_field_data(app.get_template_catalog().get(name))
+
+    def submit():
+        response = client.post('/submit?stream=1', json=copy.deepcopy(payload))
+        return response.get_data()
+
+    if 'submit' in stages:
+        seconds, packet = timed(submit)
+        result['stages']['submit'] = seconds
+        result['packet_bytes'] = len(packet)
+
+    seconds, (course_tasks, student_tasks) = timed(
+        app.build_packet_tasks, copy.deepcopy(payload))
+    if 'tasks' in stages:
+        result['stages']['tasks'] = seconds
+    manifest = list(course_tasks)
+    for _, pdf_paths, answers in student_tasks:
+        manifest.extend((pdf_path, answers) for pdf_path in pdf_paths)
+    result['checklists'] = len(manifest)
+
+    parser = app.PDFParser()
+    if 'fill_pdf' in stages:
+        result['stages']['fill_pdf'], _ = timed(
+            lambda: [parser.fill_pdf(pdf_path, answers) for pdf_path, answers in manifest])
+
+    documents = None
+    if {'fill_batch', 'join_pdfs', 'merge', 'merge_dedupe'} & set(stages):
+        seconds, documents = timed(parser.fill_batch, manifest)
+        if 'fill_batch' in stages:
+            result['stages']['fill_batch'] = seconds
+
+    if 'join_pdfs' in stages:
+        result['stages']['join_pdfs'], _ = timed(parser.join_pdfs, documents)
+
+    if 'merge' in stages:
+        def merge():
+            merger = app.PdfFileMerger()
+            for document in documents:
+                merger.append(io.BytesIO(document))
+            output = io.BytesIO()
+            merger.write(output)
+            merger.close()
+            return output
+        result['stages']['merge'], output = timed(merge)
+        result['merge_bytes'] = len(output.getvalue())
+
+    if 'merge_dedupe' in stages:
+        def merge_dedupe():
+            writer = app.StreamingPdfWriter(dedupe=True)
+            chunks = [writer.header()]
+            chunks.extend(writer.add_document(document) for document in documents)
+            chunks.append(writer.finish())
+            return b''.join(chunks)
+        result['stages']['merge_dedupe'], output = timed(merge_dedupe)
+        result['merge_dedupe_bytes'] = len(output)
+
+    if 'submit' in stages:
+        result['students_per_second'] = students / result['stages']['submit']
+    result['checklists_per_second'] = {
+        stage: result['checklists'] / result['stages'][stage]
+        for stage in ('fill_pdf', 'fill_batch') if stage in result['stages']
+    }
+
+    # the pdfparser workers only count towards RUSAGE_CHILDREN once reaped
+    app._close_worker_pool()
+    result['peak_rss_kb'], result['peak_rss_children_kb'] = peak_rss_kb()
+    return result
+
+
+def configure(args, scratch):
+    os.environ['PDFPARSER_BACKEND'] = args.backend
+    os.environ['PDFPARSER_SCHEMA_CACHE'] = os.path.join(scratch, 'schema_cache')
+    os.environ['PACKET_CACHE_DIR'] = ''
+    os.environ.setdefault('RENDER_PROCESSES', '1')
+    if args.java:
+        os.environ['PDFPARSER_PATH'] = os.path.join(REPO, 'pdfparser.jar')
+        os.environ['PDFPARSER_WORKER_PATH'] = REPO
+    else:
+        os.environ['PDFPARSER_WORKER_COMMAND'] = '{} {}'.format(
+            sys.executable, os.path.join(REPO, 'bench', 'fake_pdfparser.py'))
+
+
+def print_table(results):
+    stages = [stage for stage in STAGES
+              if any(stage in result['stages'] for result in results)]
+    header = ['students', 'checklists'] + ['{} s'.format(s) for s in stages] + \
+        ['students/s', 'packet MB', 'rss MB', 'workers MB']
+    print(' '.join('{:>12}'.format(column) for column in header))
+    for result in results:
+        row = [result['students'], result['checklists']]
+        row += ['{:.3f}'.format(result['stages'][s]) if s in result['stages'] else '-'
+                for s in stages]
+        row.append('{:.2f}'.format(result['students_per_second'])
+                   if 'students_per_second' in result else '-')
+        sizes = [result[k] / 1024 / 1024 for k in ('merge_bytes', 'merge_dedupe_bytes') if k in result]
+        row.append('/'.join('{:.1f}'.format(size) for size in sizes) or '-')
+        row.append('{:.1f}'.format(result['peak_rss_kb'] / 1024))
+        row.append('{:.1f}'.format(result['peak_rss_children_kb'] / 1024))
+        print(' '.join('{:>12}'.format(column) for column in row))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 500])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--backend', choices=('jar', 'pypdf2'), default='jar')
+    parser.add_argument('--java', action='store_true',
+                        help='use the real pdfparser.jar instead of the stand-in')
+    parser.add_argument('--json', help='also write the raw results to this file')
+    parser.add_argument('--one', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.one is not None:
+        print(json.dumps(run_size(args.one, args.stages)))
+        return
+
+    results = []
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--one', str(size),
+                   '--backend', args.backend, '--stages'] + args.stages
+        if args.java:
+            command.append('--java')
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, REPO)
+    scratch = tempfile.mkdtemp(prefix='flaskapp-bench-')
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--backend', default='jar')
+    options.add_argument('--java', action='store_true')
+    configure(options.parse_known_args()[0], scratch)
+    import app
+    from app import ROSTER_TEMPLATE
+    app.parent_directory = REPO
+    try:
+        main()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
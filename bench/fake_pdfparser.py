@@ -0,0 +1,86 @@
+"""Stand-in for PdfParserWorker.java that needs no Java.
+
+Speaks the same framed protocol (a 4 byte big-endian length followed by
+UTF-8 JSON) and the same --batch manifest mode, and runs the pdfparser
+commands with the PyPDF2 backend of app.py. Point the app at it with
+
+    PDFPARSER_WORKER_COMMAND="python bench/fake_pdfparser.py"
+"""
+import os
+import sys
+import json
+import time
+import struct
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# keep prints away from the framed channel, like the java worker does
+stdout = sys.stdout.buffer
+sys.stdout = sys.stderr
+
+import app  # noqa: E402
+
+backend = app.PyPDF2Backend()
+
+
+def run(args):
+    """Run one pdfparser command, returning what the jar would print"""
+    start = time.perf_counter_ns()
+    try:
+        command = args[0]
+        if command == 'get_fields':
+            out = json.dumps(backend.get_fields(args[1]))
+        elif command == 'set_fields':
+            answers = {}
+            for field in json.loads(args[3])['fields']:
+                answers.update(field)
+            backend.set_fields(args[1], args[2], answers)
+            out = ''
+        elif command == 'concat_files':
+            backend.concat_files(args[1:-1], args[-1])
+            out = ''
+        else:
+            raise ValueError("unknown command {!r}".format(command))
+    except Exception as e:
+        return {'out': '', 'err': repr(e), 'nanos': time.perf_counter_ns() - start}
+    # the jar escapes non ascii output, app.py decodes it with unicode_escape
+    return {'out': out.encode('ascii', 'backslashreplace').decode('latin-1'), 'err': '',
+            'nanos': time.perf_counter_ns() - start}
+
+
+def write_frame(response):
+    payload = json.dumps(response).encode('utf-8')
+    stdout.write(struct.pack('>I', len(payload)) + payload)
+    stdout.flush()
+
+
+def read_frame():
+    header = sys.stdin.buffer.read(4)
+    if len(header) < 4:
+        return None
+    length, = struct.unpack('>I', header)
+    return json.loads(sys.stdin.buffer.read(length).decode('utf-8'))
+
+
+def main(argv):
+    if len(argv) == 2 and argv[0] == '--batch':
+        with open(argv[1]) as f:
+            manifest = json.load(f)
+        stdout.write(json.dumps(
+            {'results': [run(args) for args in manifest['commands']]}).encode('utf-8'))
+        stdout.flush()
+        return
+
+    write_frame({'ready': True})
+    while True:
+        request = read_frame()
+        if request is None:
+            break
+        if 'batch' in request:
+            write_frame({'results': [run(args) for args in request['batch']]})
+        else:
+            write_frame(run(request['args']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
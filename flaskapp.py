@@ -0,0 +1,6 @@
+"""WSGI entry point: `from flaskapp import app` for flaskapp.wsgi (mod_wsgi)
+and `gunicorn -c gunicorn.conf.py flaskapp:app`.
+"""
+from app import create_app
+
+app = create_app()
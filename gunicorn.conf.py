@@ -0,0 +1,21 @@
+"""gunicorn settings, run with
+
+    gunicorn -c gunicorn.conf.py flaskapp:app
+
+Every worker process imports the app itself (no preload_app), so each one
+gets its own template catalog, field schema cache, pdfparser workers and
+render processes. Those pools are per worker: keep WEB_WORKERS times
+PDFPARSER_POOL_SIZE and RENDER_PROCESSES within what the machine can run.
+"""
+import os
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', 2))
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_class = 'gthread'
+# streamed /submit responses and big packet downloads take a while
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
@@ -0,0 +1,32 @@
+"""Render worker entry point: takes the per-student and per-checklist
+render tasks of the web processes from the RENDER_BROKER queue, e.g.
+
+    RENDER_BROKER=sqlite:////srv/flaskapp/render.db python render_worker.py
+
+Run one per host (each uses RENDER_PROCESSES cores) from the app directory,
+so the templates resolve to the same paths as in the web processes.
+"""
+import os
+import sys
+import argparse
+
+import app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--broker', help='overrides RENDER_BROKER')
+    parser.add_argument('--processes', type=int, help='overrides RENDER_PROCESSES')
+    args = parser.parse_args(argv)
+    if args.broker:
+        os.environ['RENDER_BROKER'] = args.broker
+    try:
+        app.run_render_worker(args.processes)
+    except app.InvalidOptionError as e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault("PDFPARSER_PATH", "pdfparser.jar")
+    main(sys.argv[1:])
@@ -0,0 +1,179 @@
+"""The pypdf2 backend against pdfparser.jar over the bundled ACLS, BLS and
+PALS templates. The jar comparisons are skipped when Java is unavailable.
+
+pdfparser.jar flattens what it fills, so filled values are compared by
+having both backends read the pypdf2 output.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import shutil
+
+import pytest
+from PyPDF2 import PdfFileReader
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+os.environ.setdefault('PDFPARSER_PATH', os.path.join(REPO, 'pdfparser.jar'))
+os.environ.setdefault('PDFPARSER_WORKER_PATH', REPO)
+
+import app  # noqa: E402
+
+TEMPLATES = sorted(app.TemplateCatalog(REPO).names())
+
+needs_java = pytest.mark.skipif(
+    shutil.which('java') is None or not os.path.exists(os.environ['PDFPARSER_PATH']),
+    reason='pdfparser.jar needs java')
+
+
+def template_path(name):
+    return app.TemplateCatalog(REPO).get(name)
+
+
+def answers_for(fields):
+    """A value for every field the app fills: text, a state or an option"""
+    answers = {}
+    for k, item in enumerate(fields['fields']):
+        if item['type'] == 'text':
+            answers[item['name']] = 'Value {}'.format(k)
+        elif item['type'] in ('checkbox', 'radio button', 'combo box', 'listbox'):
+            options = [option for option in item['options'] or [] if option != 'Off']
+            if options:
+                answers[item['name']] = options[0]
+    return answers
+
+
+def fill(backend, pdf_path, answers, tmp_path):
+    output_path = str(tmp_path / '{}.pdf'.format(backend.name))
+    backend.set_fields(pdf_path, output_path, answers)
+    return output_path
+
+
+def by_name(fields):
+    return {item['name']: item for item in fields['fields']}
+
+
+def page_values(pdf_path):
+    """The (field name, value) of the widgets on each page of `pdf_path`"""
+    backend = app.PyPDF2Backend()
+    pages = []
+    for page in PdfFileReader(pdf_path, strict=False).pages:
+        values = []
+        for annot in page.get('/Annots') or []:
+            annot = annot.getObject()
+            if annot.get('/Subtype') == '/Widget':
+                field = annot if '/T' in annot else backend._parent(annot)
+                values.append((backend._full_name(field), str(backend._inherited(field, '/V'))))
+        pages.append(values)
+    return pages
+
+
+@pytest.mark.parametrize('name', TEMPLATES)
+def test_pypdf2_fill_shows_values(name, tmp_path):
+    backend = app.PyPDF2Backend()
+    pdf_path = template_path(name)
+    fields = backend.get_fields(pdf_path)
+    answers = answers_for(fields)
+    output_path = fill(backend, pdf_path, answers, tmp_path)
+
+    filled = by_name(backend.get_fields(output_path))
+    for field_name, value in answers.items():
+        assert filled[field_name]['value'] == value
+
+    # the value has to be in the widget's appearance, merged packets
+    # lose /NeedAppearances
+    reader = PdfFileReader(output_path, strict=False)
+    for field, annot in backend._widgets(reader):
+        field_name = backend._full_name(field)
+        if backend._field_type(field) != 'text' or field_name not in answers:
+            continue
+        appearance = annot['/AP']['/N']
+        assert app.FieldPainter()._escape(answers[field_name]) in appearance.getData(), field_name
+
+
+@needs_java
+@pytest.mark.parametrize('name', TEMPLATES)
+def test_get_fields_matches_jar(name):
+    pdf_path = template_path(name)
+    jar = by_name(app.JarBackend().get_fields(pdf_path))
+    pypdf2 = by_name(app.PyPDF2Backend().get_fields(pdf_path))
+    assert sorted(jar) == sorted(pypdf2)
+    for field_name, item in jar.items():
+        assert pypdf2[field_name]['type'] == item['type'], field_name
+        assert sorted(pypdf2[field_name]['options'] or []) == \
+            sorted(item.get('options') or []), field_name
+        assert (pypdf2[field_name]['value'] or '') == (item['value'] or ''), field_name
+
+
+@needs_java
+@pytest.mark.parametrize('name', TEMPLATES)
+def test_filled_values_match_jar(name, tmp_path):
+    pdf_path = template_path(name)
+    backend = app.PyPDF2Backend()
+    answers = answers_for(backend.get_fields(pdf_path))
+    output_path = fill(backend, pdf_path, answers, tmp_path)
+    jar = by_name(app.JarBackend().get_fields(output_path))
+    pypdf2 = by_name(backend.get_fields(output_path))
+    for field_name, value in answers.items():
+        assert pypdf2[field_name]['value'] == value, field_name
+        assert jar[field_name]['value'] == value, field_name
+
+
+@needs_java
+def test_concat_files_matches_jar(tmp_path):
+    backend = app.PyPDF2Backend()
+    documents = []
+    for k, name in enumerate(TEMPLATES[:3]):
+        pdf_path = template_path(name)
+        output_dir = tmp_path / str(k)
+        output_dir.mkdir()
+        documents.append(fill(backend, pdf_path, answers_for(backend.get_fields(pdf_path)),
+                              output_dir))
+    jar_path = str(tmp_path / 'jar.pdf')
+    pypdf2_path = str(tmp_path / 'pypdf2.pdf')
+    app.JarBackend().concat_files(documents, jar_path)
+    backend.concat_files(documents, pypdf2_path)
+
+    expected = [page for document in documents for page in page_values(document)]
+    assert page_values(jar_path) == expected
+    assert page_values(pypdf2_path) == expected
+
+
+def test_check_rejects_values_outside_the_options():
+    checked = 0
+    for name in TEMPLATES:
+        template = app.CompiledTemplate(app.PyPDF2Backend().get_fields(template_path(name)))
+        for field_name, options in template.options.items():
+            assert template.check({field_name: options[-1]}) == {field_name: options[-1]}
+            with pytest.raises(app.InvalidOptionError):
+                template.check({field_name: 'no such option'})
+            with pytest.raises(app.InvalidOptionError):
+                template.check({field_name: ['unhashable']})
+            checked += 1
+    assert checked
+
+
+def test_pypdf2_fills_export_values(tmp_path):
+    """A radio group with an /Opt takes its export values, like the jar"""
+    backend = app.PyPDF2Backend()
+    pdf_path = template_path('Adult HighQuality BLS Skills Testing Checklist_ucm_506696_unlocked')
+    item = by_name(backend.get_fields(pdf_path))['PASS/NR 1']
+    assert item['value'] == 'Choice1'
+    assert app.CompiledTemplate(backend.get_fields(pdf_path)).check({'PASS/NR 1': 'Choice2'})
+
+    output_path = fill(backend, pdf_path, {'PASS/NR 1': 'Choice2'}, tmp_path)
+    assert by_name(backend.get_fields(output_path))['PASS/NR 1']['value'] == 'Choice2'
+    reader = PdfFileReader(output_path, strict=False)
+    states = [annot['/AS'] for field, annot in backend._widgets(reader)
+              if backend._full_name(field) == 'PASS/NR 1']
+    assert states == ['/Off', '/1']
+
+
+@needs_java
+@pytest.mark.parametrize('name', TEMPLATES)
+def test_options_check_matches_jar(name):
+    pdf_path = template_path(name)
+    jar = app.CompiledTemplate(app.JarBackend().get_fields(pdf_path))
+    pypdf2 = app.CompiledTemplate(app.PyPDF2Backend().get_fields(pdf_path))
+    assert jar.domains == pypdf2.domains
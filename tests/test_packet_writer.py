@@ -0,0 +1,148 @@
+"""Packets written by StreamingPdfWriter and PdfUpdateWriter, read back
+with PyPDF2. Everything is filled with the pypdf2 backend, so no Java is
+needed.
+
+    python -m pytest tests
+"""
+import copy
+import io
+import os
+import sys
+
+import pytest
+from PyPDF2 import PdfFileReader
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import app  # noqa: E402
+
+ROSTER = '2020 Guidelines BLS Course Roster_ucm_506772_unlocked (1)'
+AIRWAY = 'Airway Management Skills Testing Checklist_ucm_506697_unlocked'
+CPR = 'Adult CPR and AED Skills Testing Checklist_ucm_506673_unlocked'
+ASYSTOLE = 'PALS_Testing_Checklist_Cardiac_Asystole_PEA_ucm_506923_unlocked'
+
+
+@pytest.fixture
+def packets(tmp_path, monkeypatch):
+    """Render into `tmp_path` with the bundled templates, in this process"""
+    monkeypatch.setenv('PDFPARSER_BACKEND', 'pypdf2')
+    monkeypatch.setenv('RENDER_MODE', 'fill')
+    monkeypatch.setenv('RENDER_PROCESSES', '1')
+    monkeypatch.delenv('RENDER_BROKER', raising=False)
+    monkeypatch.setattr(app, 'parent_directory', str(tmp_path))
+    monkeypatch.setattr(app, 'template_catalog', app.TemplateCatalog(REPO))
+    monkeypatch.setattr(app, 'field_schema_cache', app.FieldSchemaCache())
+    monkeypatch.setattr(app, 'packet_index', app.PacketIndex(str(tmp_path / 'index')))
+    monkeypatch.setattr(app, 'packet_cache', app.PacketCache('', 0))
+    return tmp_path
+
+
+def page_values(pdf):
+    """The (field name, value) of the widgets on each page of `pdf`, a path
+    or pdf bytes
+    """
+    backend = app.PyPDF2Backend()
+    reader = PdfFileReader(io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf, strict=False)
+    pages = []
+    for page in reader.pages:
+        values = []
+        for annot in page.get('/Annots') or []:
+            annot = annot.getObject()
+            if annot.get('/Subtype') != '/Widget':
+                continue
+            field = annot if '/T' in annot else backend._parent(annot)
+            value = backend._inherited(field, '/V')
+            values.append((backend._full_name(field), None if value is None else str(value)))
+        pages.append(values)
+    return pages
+
+
+def filled(name, tag):
+    """`name` filled with a value naming `tag` in every text field"""
+    backend = app.PyPDF2Backend()
+    pdf_path = app.TemplateCatalog(REPO).get(name)
+    answers = {item['name']: '{} {}'.format(tag, k)
+               for k, item in enumerate(backend.get_fields(pdf_path)['fields'])
+               if item['type'] == 'text'}
+    return app.PDFParser(clean_up=True).fill_pdf(pdf_path, answers)
+
+
+def payload(students, output_file):
+    course_info = {'Lead Instructor': 'Lead', 'Lead Instructor ID#': '7',
+                   'Card Expiration Date': '1/1/2022', 'Instructor Initials': 'LI',
+                   'Instructor Number': '42'}
+    participants = {'student-info': []}
+    for k, student in enumerate(students):
+        for field in ('name', 'email', 'phone'):
+            participants['cp-{}-{}'.format(field, k)] = '{} {}'.format(student, field)
+        participants['student-info'].append({
+            'cp-name': student, 'cp-dot': '1/2/2021',
+            'selected-checkboxes': [CPR, ASYSTOLE] if k % 2 else [CPR]})
+    return {
+        'outputFileName': output_file,
+        'selectedOptions': [ROSTER, AIRWAY],
+        'courseInfo': course_info,
+        'assistingInstructors': {'assis-name-0': 'A', 'assis-card-exp-0': '1/1/2022'},
+        'courseParticipants': {'Course': 'BLS', 'Lead Instructor Signature': 'Lead',
+                               'Date': '1/1/2021'},
+        'courseParticipants1': participants,
+    }
+
+
+def render(json_obj):
+    app.render_packet(copy.deepcopy(json_obj))
+    return app.assemble_packet(json_obj['outputFileName'])
+
+
+def test_concat_pdfs_keeps_pages_and_values(packets):
+    documents = [filled(AIRWAY, 'first'), filled(CPR, 'second'), filled(AIRWAY, 'third')]
+    merged = app.concat_pdfs(documents)
+
+    expected = [page for document in documents for page in page_values(document)]
+    assert PdfFileReader(io.BytesIO(merged), strict=False).getNumPages() == len(expected)
+    assert page_values(merged) == expected
+    assert any(value == 'third 0' for page in expected for _, value in page)
+
+
+@pytest.mark.parametrize('merge_mode', ['plain', 'dedupe'])
+def test_write_merged_keeps_pages_and_values(packets, monkeypatch, merge_mode):
+    monkeypatch.setenv('MERGE_MODE', merge_mode)
+    # the same template over and over is what dedupe shares objects of
+    segments = [[filled(AIRWAY, 'student {}'.format(k)), filled(CPR, 'student {}'.format(k))]
+                for k in range(3)]
+    output = io.BytesIO()
+    pages = app.write_merged(output, segments)
+
+    merged = page_values(output.getvalue())
+    start = 0
+    for segment, segment_pages in zip(segments, pages):
+        expected = [page for document in segment for page in page_values(document)]
+        assert segment_pages == [start, start + len(expected)]
+        assert merged[start:start + len(expected)] == expected
+        start += len(expected)
+    assert len(merged) == start
+
+
+@pytest.mark.parametrize('merge_mode', ['plain', 'dedupe'])
+def test_incremental_updates_match_fresh_render(packets, monkeypatch, merge_mode):
+    monkeypatch.setenv('MERGE_MODE', merge_mode)
+    students = ['Student {}'.format(k) for k in range(5)]
+    original = payload(students, 'updated')
+    packet_path = render(original)
+
+    renamed = payload(students[:2] + ['Renamed'] + students[3:], 'updated')
+    app.update_packet(copy.deepcopy(renamed))
+    removed = payload(students[:2] + ['Renamed'] + students[4:], 'updated')
+    app.update_packet(copy.deepcopy(removed))
+
+    index = app.packet_index.load(packet_path)
+    # both updates were appended to the merged packet, not re-merged
+    assert app.packet_index.is_assembled(packet_path, index)
+    assert [segment['name'] for segment in index['segments']] == \
+        [None, 'Student 0', 'Student 1', 'Renamed', 'Student 4']
+
+    fresh_path = render(payload(students[:2] + ['Renamed'] + students[4:], 'fresh'))
+    assert page_values(packet_path) == page_values(fresh_path)
+    assert [segment['pages'] for segment in index['segments']] == \
+        [segment['pages'] for segment in app.packet_index.load(fresh_path)['segments']]